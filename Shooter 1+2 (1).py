@@ -4,52 +4,788 @@ import pygame
 import random
 import math
 import sys
-
-pygame.init()
-
-screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-WIDTH, HEIGHT = screen.get_size()
-screen_width = pygame.display.Info().current_w
+import os
+import heapq
+import time
+import csv
+import json
+import pickle
+import threading
+import shutil
+import tempfile
+import atexit
+import zlib
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+STARTED_AT = time.perf_counter()
+
+screen = None
+WIDTH, HEIGHT = 800, 600
+screen_width = WIDTH
 scale_factor = screen_width / 800
 
 TILE_SIZE = 50
 FPS = 60
+# Отрисовка не привязана к TICK_RATE: частота дисплея, --max-fps (0 — без ограничения)
+# или DEFAULT_RENDER_FPS, если частоту дисплея узнать нельзя
+DEFAULT_RENDER_FPS = 144
+RENDER_FPS = DEFAULT_RENDER_FPS
+TICK_RATE = 60
+TICK_MS = 1000 / TICK_RATE
+STEP_SCALE = 60 / TICK_RATE
+MAX_TICKS_PER_FRAME = 5
 
-clock = pygame.time.Clock()
+clock = None
 
-HEART_SIZE = int(30 * scale_factor)
-directions = {
-    'UP': (0, HEIGHT - 40),
-    'DOWN': (0, -HEIGHT + 40),
-    'LEFT': (WIDTH - 40, 0),
-    'RIGHT': (-WIDTH + 40, 0)
-}
+directions = {}
 
 RELOAD_EVENT = pygame.USEREVENT + 1
 HEART_SIZE = 30
+LASER_MS = 120
+
+
+def init_game(headless=False, size=None):
+    global screen, WIDTH, HEIGHT, screen_width, scale_factor, clock, directions, RENDER_FPS
+    if headless:
+        # Без окна и без микшера: логика работает на обычной поверхности в памяти
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        pygame.display.init()
+        pygame.font.init()
+        screen = pygame.Surface(size or (1920, 1080))
+    else:
+        pygame.init()
+        # vsync — лишь просьба: без SCALED/OPENGL SDL может её не выполнить
+        if size:
+            screen = pygame.display.set_mode(size, vsync=1)
+        else:
+            screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN, vsync=1)
+        # Частоту дисплея умеет отдавать только pygame-ce; без неё ограничиваемся DEFAULT_RENDER_FPS,
+        # чтобы цикл не крутился вхолостую на всё ядро
+        refresh_rate = getattr(pygame.display, "get_current_refresh_rate", None)
+        RENDER_FPS = (refresh_rate() if refresh_rate else 0) or DEFAULT_RENDER_FPS
+
+    WIDTH, HEIGHT = screen.get_size()
+    screen_width = WIDTH
+    scale_factor = screen_width / 800
+    clock = pygame.time.Clock()
+    directions = {
+        'UP': (0, HEIGHT - 40),
+        'DOWN': (0, -HEIGHT + 40),
+        'LEFT': (WIDTH - 40, 0),
+        'RIGHT': (-WIDTH + 40, 0)
+    }
+    return screen
+
+
+def set_tick_rate(rate):
+    global TICK_RATE, TICK_MS, STEP_SCALE
+    TICK_RATE = rate
+    TICK_MS = 1000 / rate
+    # Скорости в коде заданы в пикселях за кадр при 60 FPS
+    STEP_SCALE = 60 / rate
+
+
+class SimClock:
+    def __init__(self):
+        self.time = 0.0
+        self.tick = 0
+
+    def reset(self):
+        self.time = 0.0
+        self.tick = 0
+
+    def advance(self):
+        self.tick += 1
+        self.time = self.tick * TICK_MS
+
+
+sim_clock = SimClock()
+
+
+def now():
+    return sim_clock.time
+
+
+class RandomStreams:
+    # Отдельные потоки: генерация комнат, бой и косметика не сбивают друг друга
+    def __init__(self, seed=None):
+        self.combat = random.Random()
+        self.particles = np.random.default_rng()
+        self.reseed(seed)
+
+    def reseed(self, seed=None):
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.run = 0
+        self.combat.seed(f"{self.seed}:combat")
+        self.particles.bit_generator.state = np.random.PCG64([self.seed, 1]).state
+
+    def new_run(self):
+        self.run += 1
+
+    def room(self, coord, number):
+        # Комната зависит только от сида, забега, координат и номера — не от того, какой поток её построил
+        return random.Random(f"{self.seed}:{self.run}:{coord[0]}:{coord[1]}:{number}")
 
-shoot_sound = pygame.mixer.Sound('shoot.wav')
-hit_sound = pygame.mixer.Sound('hit.wav')
-death_sound = pygame.mixer.Sound('death.wav')
-reload_sound = pygame.mixer.Sound('reload.wav')
-buy_sound = pygame.mixer.Sound('buy.wav')
-
-def has_line_of_sight(start_pos, end_pos, walls):
-    line = pygame.Rect(0, 0, 1, 1)
-    steps = int(pygame.Vector2(end_pos).distance_to(start_pos) // 5)
-    for i in range(steps):
-        x = start_pos[0] + (end_pos[0] - start_pos[0]) * i / steps
-        y = start_pos[1] + (end_pos[1] - start_pos[1]) * i / steps
-        point = pygame.Rect(x, y, 2, 2)
-        if any(point.colliderect(wall) for wall in walls):
+
+streams = RandomStreams()
+
+
+class ProfileScope:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, (time.perf_counter() - self.start) * 1000)
+
+
+class Profiler:
+    PHASES = ("input", "simulation", "transition", "flow_field", "movement", "bullets", "collisions",
+              "particles", "traps", "room_change", "draw", "static", "dynamic", "overlays", "hud", "present",
+              "audio")
+    COUNTS = ("bullets", "enemy_bullets", "blood", "wind", "enemies", "pixels_pushed")
+    BUDGET_MS = 1000 / 60
+
+    def __init__(self, window=240):
+        self.samples = deque(maxlen=window)
+        self.scopes = {}
+        self.current = {}
+        self.counts = {}
+        self.frame_start = time.perf_counter()
+        self.frames = 0
+        self.discarded = False
+        self.csv_file = None
+        self.csv_writer = None
+
+    def scope(self, name):
+        scope = self.scopes.get(name)
+        if scope is None:
+            scope = self.scopes[name] = ProfileScope(self, name)
+        return scope
+
+    def add(self, name, ms):
+        self.current[name] = self.current.get(name, 0.0) + ms
+
+    def begin_frame(self):
+        self.current = {}
+        self.discarded = False
+        self.frame_start = time.perf_counter()
+
+    def discard_frame(self):
+        # Кадр с паузой, меню или выбором перка ждал игрока: в статистику он не попадает
+        self.discarded = True
+
+    def end_frame(self, counts=None):
+        total = (time.perf_counter() - self.frame_start) * 1000
+        self.counts = counts or {}
+        if self.discarded:
+            return
+        self.samples.append((total, self.current))
+        self.frames += 1
+        if self.csv_writer:
+            self.csv_writer.writerow([self.frames, "%.3f" % total]
+                                     + ["%.3f" % self.current.get(name, 0.0) for name in self.PHASES]
+                                     + [self.counts.get(name, 0) for name in self.COUNTS])
+
+    def open_csv(self, path):
+        self.csv_file = open(path, "w", newline="")
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(["frame", "total_ms"] + [f"{name}_ms" for name in self.PHASES] + list(self.COUNTS))
+
+    def close(self):
+        if self.csv_file:
+            self.csv_file.close()
+            self.csv_file = self.csv_writer = None
+
+    @staticmethod
+    def percentile(values, fraction):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+    def stats(self):
+        count = len(self.samples) or 1
+        totals = [total for total, _ in self.samples]
+        phases = {}
+        for name in self.PHASES:
+            values = [phases_ms.get(name, 0.0) for _, phases_ms in self.samples]
+            if any(values):
+                phases[name] = (sum(values) / count, self.percentile(values, 0.99))
+        return {
+            "frame": (sum(totals) / count, self.percentile(totals, 0.99)),
+            "over_budget": sum(1 for total in totals if total > self.BUDGET_MS),
+            "phases": phases,
+        }
+
+    def render(self):
+        stats = self.stats()
+        avg, p99 = stats["frame"]
+        rows = [(("ms", "avg", "p99"), (200, 200, 200)),
+                (("frame", f"{avg:.2f}", f"{p99:.2f}"), (255, 80, 80) if p99 > self.BUDGET_MS else (0, 255, 0))]
+        for name, (avg, p99) in stats["phases"].items():
+            rows.append(((name, f"{avg:.2f}", f"{p99:.2f}"), (255, 255, 255)))
+        for name in self.COUNTS:
+            rows.append(((name, str(self.counts.get(name, 0)), ""), (0, 255, 255)))
+
+        # Шрифт не моноширинный: числа выравниваем по правому краю своих колонок
+        surface = pygame.Surface((220, 16 * len(rows) + 4), pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 170))
+        for i, ((name, first, second), color) in enumerate(rows):
+            y = 2 + i * 16
+            surface.blit(text_cache.render(name, 20, color), (4, y))
+            for text, right in ((first, 160), (second, 216)):
+                if text:
+                    image = text_cache.render(text, 20, color)
+                    surface.blit(image, (right - image.get_width(), y))
+        return surface
+
+
+profiler = Profiler()
+
+
+class EventBus:
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, kind, callback):
+        self.subscribers.setdefault(kind, []).append(callback)
+
+    def unsubscribe(self, kind, callback):
+        if callback in self.subscribers.get(kind, ()):
+            self.subscribers[kind].remove(callback)
+
+    def emit(self, kind, *args):
+        for callback in self.subscribers.get(kind, ()):
+            callback(*args)
+
+
+events = EventBus()
+
+
+def play_sound(name):
+    events.emit("sound", name)
+
+
+class SoundPlayer:
+    # Запросы за кадр копятся и проигрываются разом в flush(): одинаковые звуки
+    # сливаются в один запуск, каналов хватает и в мясорубке.
+    # имя: (файл, приоритет, максимум одновременных голосов)
+    # Все звуки и так играют на полной громкости, как раньше, поэтому поднимать её
+    # по числу повторов некуда: слитый залп звучит как один выстрел
+    CUES = {
+        "shoot": ('shoot.wav', 1, 3),
+        "hit": ('hit.wav', 1, 2),
+        "death": ('death.wav', 2, 2),
+        "reload": ('reload.wav', 2, 1),
+        "buy": ('buy.wav', 3, 1),
+        "player_hit": ('hit.wav', 5, 1),
+        "player_death": ('death.wav', 5, 1),
+    }
+    # Эти звуки играют только на зарезервированных каналах, их никто не вытеснит
+    CRITICAL = ("player_hit", "player_death")
+    # Первые каналы отданы MusicPlayer, за ними резерв под CRITICAL
+    MUSIC_CHANNELS = 2
+    RESERVED_CHANNELS = 2
+    MAX_VOICES = 8
+
+    def __init__(self, bus, loaded=None):
+        loaded = dict(loaded or {})
+        for path in self.files():
+            if path not in loaded:
+                loaded[path] = pygame.mixer.Sound(path)
+        self.sounds = {name: loaded[path] for name, (path, _, _) in self.CUES.items()}
+        first = self.MUSIC_CHANNELS + self.RESERVED_CHANNELS
+        pygame.mixer.set_num_channels(first + self.MAX_VOICES)
+        pygame.mixer.set_reserved(first)
+        self.reserved = [pygame.mixer.Channel(i) for i in range(self.MUSIC_CHANNELS, first)]
+        self.voices = [pygame.mixer.Channel(i) for i in range(first, first + self.MAX_VOICES)]
+        # канал -> (имя, приоритет, номер запуска); по номеру выбираем самый старый голос
+        self.playing = {}
+        self.started = 0
+        self.pending = {}
+        self.requested = 0
+        self.played = 0
+        self.dropped = 0
+        self.stolen = 0
+        bus.subscribe("sound", self.play)
+
+    @classmethod
+    def files(cls):
+        return sorted({path for path, _, _ in cls.CUES.values()})
+
+    def play(self, name):
+        self.pending[name] = self.pending.get(name, 0) + 1
+        self.requested += 1
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending = sorted(self.pending.items(), key=lambda item: -self.CUES[item[0]][1])
+        self.pending = {}
+        for channel in list(self.playing):
+            if not channel.get_busy():
+                del self.playing[channel]
+        for name, _ in pending:
+            _, priority, limit = self.CUES[name]
+            channel = self.channel_for(name, priority, limit)
+            if channel is None:
+                self.dropped += 1
+                continue
+            channel.play(self.sounds[name])
+            self.started += 1
+            self.playing[channel] = (name, priority, self.started)
+            self.played += 1
+
+    def channel_for(self, name, priority, limit):
+        pool = self.reserved if name in self.CRITICAL else self.voices
+        same = [channel for channel in pool if self.playing.get(channel, ("",))[0] == name]
+        if len(same) >= limit:
+            # Лимит звука исчерпан: перезапускаем его самый старый голос
+            self.stolen += 1
+            return min(same, key=lambda channel: self.playing[channel][2])
+        for channel in pool:
+            if channel not in self.playing:
+                return channel
+        weaker = [channel for channel in pool if self.playing[channel][1] < priority]
+        if name in self.CRITICAL:
+            weaker = pool
+        if not weaker:
+            return None
+        self.stolen += 1
+        return min(weaker, key=lambda channel: (self.playing[channel][1], self.playing[channel][2]))
+
+    def stats(self):
+        return {"requested": self.requested, "played": self.played, "dropped": self.dropped,
+                "stolen": self.stolen, "voices": len(self.playing)}
+
+
+class MusicPlayer:
+    # Дорожки декодируются в Sound в фоне и играют на своих каналах:
+    # смена комнаты только меняет цель, громкости плавно сходятся в update().
+    # Неактивная дорожка ставится на паузу и продолжает с того же места.
+    # Музыка торговца нужна редко и грузится, только когда впервые понадобится.
+    NORMAL_TRACK = 'Waveshaper - Client.mp3'
+    TRADER_TRACK = 'mystery_shop.wav'
+    TRACKS = {"normal": NORMAL_TRACK, "trader": TRADER_TRACK}
+    PRELOAD = ("normal",)
+    VOLUME = 0.1
+    FADE_MS = 1500
+
+    def __init__(self, bus, executor=None):
+        self.current_music_type = "normal"
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="music-loader")
+        self.loading = {}
+        self.tracks = {}
+        for name in self.PRELOAD:
+            self.request(name)
+        self.channels = {name: pygame.mixer.Channel(index) for index, name in enumerate(self.TRACKS)}
+        self.volumes = dict.fromkeys(self.TRACKS, 0.0)
+        self.started = set()
+        self.last_update = time.perf_counter()
+        bus.subscribe("room_changed", self.on_room_changed)
+
+    @staticmethod
+    def load(path):
+        try:
+            return pygame.mixer.Sound(path)
+        except (pygame.error, FileNotFoundError) as error:
+            # Без дорожки игра просто идёт в тишине
+            print(f"music: cannot load {path}: {error}", file=sys.stderr)
+            return None
+
+    def request(self, name):
+        if name not in self.tracks and name not in self.loading:
+            self.loading[name] = self.executor.submit(self.load, self.TRACKS[name])
+
+    def on_room_changed(self, room):
+        self.current_music_type = "trader" if room.trader else "normal"
+        self.request(self.current_music_type)
+
+    def resume(self):
+        # update() не зовётся в паузе и при выборе перка: время ожидания в затухание не идёт
+        self.last_update = time.perf_counter()
+
+    def update(self):
+        current = time.perf_counter()
+        elapsed = (current - self.last_update) * 1000
+        step = elapsed / self.FADE_MS * self.VOLUME
+        self.last_update = current
+        for name, future in list(self.loading.items()):
+            if future.done():
+                del self.loading[name]
+                self.tracks[name] = future.result()
+
+        for name, channel in self.channels.items():
+            sound = self.tracks.get(name)
+            if sound is None:
+                continue
+            target = self.VOLUME if name == self.current_music_type else 0.0
+            volume = self.volumes[name]
+            if volume == target:
+                continue
+            if target > volume:
+                if name not in self.started:
+                    channel.play(sound, loops=-1)
+                    self.started.add(name)
+                elif volume == 0.0:
+                    channel.unpause()
+                volume = min(target, volume + step)
+            else:
+                volume = max(target, volume - step)
+                if volume == 0.0:
+                    channel.pause()
+            self.volumes[name] = volume
+            channel.set_volume(volume)
+
+
+class AssetCache:
+    # Кэшем пользуются главный поток, предзагрузка и постройка комнат (Room() создаёт торговца
+    # и врагов в фоне), поэтому словарь трогаем только под замком. Сами чтение и масштабирование
+    # идут без замка; если два потока загрузили одно и то же, в кэше остаётся первая копия
+    def __init__(self):
+        self.surfaces = {}
+        self.loads = 0
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def image(self, path, size=None, alpha=True):
+        key = (path, tuple(size) if size else None, alpha)
+        raw_key = (path, None, alpha)
+        with self.lock:
+            surface = self.surfaces.get(key)
+            if surface is not None:
+                self.hits += 1
+                return surface
+            surface = self.surfaces.get(raw_key)
+
+        if surface is None:
+            surface = self.adopt(path, self.decode(path), alpha)
+        if size:
+            scaled = pygame.transform.scale(surface, key[1])
+            with self.lock:
+                surface = self.surfaces.setdefault(key, scaled)
+        return surface
+
+    @staticmethod
+    def decode(path):
+        # Только чтение и распаковка файла: безопасно вызывать из пула потоков
+        return pygame.image.load(path)
+
+    def adopt(self, path, surface, alpha=True):
+        # convert() только приводит пиксели к формату экрана. Стартовые картинки приводит
+        # главный поток, а редкие, вроде торговца, — тот поток, что первым их запросил
+        if pygame.display.get_surface() is None:
+            pass
+        elif alpha:
+            surface = surface.convert_alpha()
+        else:
+            surface = surface.convert()
+        with self.lock:
+            surface = self.surfaces.setdefault((path, None, alpha), surface)
+            self.loads += 1
+        return surface
+
+    def memory_usage(self):
+        with self.lock:
+            surfaces = list(self.surfaces.values())
+        return sum(s.get_width() * s.get_height() * s.get_bytesize() for s in surfaces)
+
+    def report(self):
+        return {
+            "surfaces": len(self.surfaces),
+            "files_decoded": self.loads,
+            "cache_hits": self.hits,
+            "bytes": self.memory_usage(),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.surfaces.clear()
+
+
+assets = AssetCache()
+
+
+class TextCache:
+    def __init__(self, limit=512):
+        self.limit = limit
+        self.fonts = {}
+        self.surfaces = {}
+        self.renders = 0
+        self.hits = 0
+
+    def font(self, size, name=None):
+        key = (name, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = pygame.font.Font(name, size)
+            self.fonts[key] = font
+        return font
+
+    def render(self, text, size, color, name=None):
+        key = (name, size, text, tuple(color))
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            return surface
+        if len(self.surfaces) >= self.limit:
+            self.surfaces.clear()
+        surface = self.font(size, name).render(text, True, color)
+        self.surfaces[key] = surface
+        self.renders += 1
+        return surface
+
+
+text_cache = TextCache()
+
+
+def grid_cells_along(start, end, size):
+    # DDA: клетки сетки, через которые проходит отрезок, в порядке прохождения
+    x0, y0 = start
+    x1, y1 = end
+    cx, cy = int(x0 // size), int(y0 // size)
+    ex, ey = int(x1 // size), int(y1 // size)
+    dx, dy = x1 - x0, y1 - y0
+    step_x = 1 if dx > 0 else -1
+    step_y = 1 if dy > 0 else -1
+    t_max_x = ((cx + (step_x > 0)) * size - x0) / dx if dx else math.inf
+    t_max_y = ((cy + (step_y > 0)) * size - y0) / dy if dy else math.inf
+    t_delta_x = size / abs(dx) if dx else math.inf
+    t_delta_y = size / abs(dy) if dy else math.inf
+    yield cx, cy
+    for _ in range(abs(ex - cx) + abs(ey - cy)):
+        if t_max_x < t_max_y:
+            cx += step_x
+            t_max_x += t_delta_x
+        else:
+            cy += step_y
+            t_max_y += t_delta_y
+        yield cx, cy
+
+
+class WallGrid:
+    # Старая проверка видимости: точки через каждые SIGHT_STEP пикселей, проба SIGHT_PROBE x SIGHT_PROBE
+    SIGHT_STEP = 5
+    SIGHT_PROBE = 2
+
+    def __init__(self, walls, cell_size=100):
+        self.walls = list(walls)
+        self.cell_size = cell_size
+        # Стена с запасом на пробу и округление координат: если проба задевает стену,
+        # отрезок гарантированно пересекает её расширенный прямоугольник
+        self.probes = [wall.inflate(2 * self.SIGHT_PROBE + 2, 2 * self.SIGHT_PROBE + 2) for wall in self.walls]
+        self.cells = {}
+        for index, probe in enumerate(self.probes):
+            for cell in self.cells_for(probe):
+                self.cells.setdefault(cell, []).append(index)
+        self.sight_cache = {}
+        self.sight_queries = 0
+        self.sight_hits = 0
+
+    def cells_for(self, rect):
+        size = self.cell_size
+        for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                yield cx, cy
+
+    def begin_frame(self):
+        self.sight_cache.clear()
+
+    def cells_along(self, start, end):
+        return grid_cells_along(start, end, self.cell_size)
+
+    def colliding(self, rect):
+        found = []
+        for cell in self.cells_for(rect):
+            for index in self.cells.get(cell, ()):
+                if index not in found and self.walls[index].colliderect(rect):
+                    found.append(index)
+        return found
+
+    def move_and_slide(self, rect, dx, dy):
+        # Оси разрешаем по очереди: упёршись в стену по одной оси, продолжаем скользить по другой.
+        # Упираемся только в стены, которые до шага были впереди по этой оси: если прямоугольник
+        # уже сидит в стене, его не перебрасывает на дальнюю сторону
+        left, right = rect.left, rect.right
+        rect.x += dx
+        walls = [self.walls[index] for index in self.colliding(rect)]
+        if dx > 0:
+            rect.right = min([wall.left for wall in walls if right <= wall.left], default=rect.right)
+        elif dx < 0:
+            rect.left = max([wall.right for wall in walls if left >= wall.right], default=rect.left)
+        top, bottom = rect.top, rect.bottom
+        rect.y += dy
+        walls = [self.walls[index] for index in self.colliding(rect)]
+        if dy > 0:
+            rect.bottom = min([wall.top for wall in walls if bottom <= wall.top], default=rect.bottom)
+        elif dy < 0:
+            rect.top = max([wall.bottom for wall in walls if top >= wall.bottom], default=rect.top)
+        return rect
+
+    def free_spot(self, rect, bounds=None, depth=3):
+        # Ближайшее свободное место: прижимаемся к сторонам мешающих стен, пока не найдём место без пересечений
+        if bounds is None:
+            bounds = pygame.Rect(0, 0, WIDTH, HEIGHT)
+        frontier = [rect.clamp(bounds)]
+        seen = {frontier[0].topleft}
+        for _ in range(depth + 1):
+            free = []
+            expanded = []
+            for candidate in frontier:
+                hits = self.colliding(candidate)
+                if not hits:
+                    free.append(candidate)
+                    continue
+                for index in hits:
+                    wall = self.walls[index]
+                    for moved in (candidate.move(0, wall.top - candidate.bottom),
+                                  candidate.move(0, wall.bottom - candidate.top),
+                                  candidate.move(wall.left - candidate.right, 0),
+                                  candidate.move(wall.right - candidate.left, 0)):
+                        moved = moved.clamp(bounds)
+                        if moved.topleft not in seen:
+                            seen.add(moved.topleft)
+                            expanded.append(moved)
+            if free:
+                return min(free, key=lambda r: abs(r.x - rect.x) + abs(r.y - rect.y))
+            frontier = expanded
+        return rect
+
+    def walls_along(self, start, end):
+        seen = set()
+        for cell in self.cells_along(start, end):
+            for index in self.cells.get(cell, ()):
+                if index not in seen:
+                    seen.add(index)
+                    yield index
+
+    def line_of_sight(self, start_pos, end_pos):
+        # Сетка отбирает стены рядом с отрезком, а ответ даёт та же выборка точек, что и раньше:
+        # результат совпадает со старой проверкой по всем стенам, но считается только для кандидатов
+        self.sight_queries += 1
+        key = (tuple(start_pos), tuple(end_pos))
+        cached = self.sight_cache.get(key)
+        if cached is not None:
+            self.sight_hits += 1
+            return cached
+
+        visible = True
+        steps = int(pygame.Vector2(end_pos).distance_to(start_pos) // self.SIGHT_STEP)
+        if steps:
+            for index in self.walls_along(start_pos, end_pos):
+                clipped = self.probes[index].clipline(start_pos, end_pos)
+                if clipped and self.sampled_hit(start_pos, end_pos, steps, clipped, self.walls[index]):
+                    visible = False
+                    break
+        self.sight_cache[key] = visible
+        return visible
+
+    def sampled_hit(self, start_pos, end_pos, steps, clipped, wall):
+        # Пробы старой проверки, которые могут задеть стену, лежат на отрезке внутри её расширенного
+        # прямоугольника: перебираем только их номера, с запасом в шаг на округление clipline
+        dx = end_pos[0] - start_pos[0]
+        dy = end_pos[1] - start_pos[1]
+        axis = 0 if abs(dx) >= abs(dy) else 1
+        span = dx if axis == 0 else dy
+        t1 = (clipped[0][axis] - start_pos[axis]) / span
+        t2 = (clipped[1][axis] - start_pos[axis]) / span
+        first = max(0, int(min(t1, t2) * steps) - 1)
+        last = min(steps - 1, int(max(t1, t2) * steps) + 2)
+        for i in range(first, last + 1):
+            x = start_pos[0] + dx * i / steps
+            y = start_pos[1] + dy * i / steps
+            if pygame.Rect(x, y, self.SIGHT_PROBE, self.SIGHT_PROBE).colliderect(wall):
+                return True
+        return False
+
+
+def has_line_of_sight(start_pos, end_pos, wall_grid):
+    return wall_grid.line_of_sight(start_pos, end_pos)
+
+
+class FlowField:
+    WALL_COST = 8
+    NEIGHBOURS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+    def __init__(self, walls, cell_size=100):
+        self.cell_size = cell_size
+        self.cols = max(1, math.ceil(WIDTH / cell_size))
+        self.rows = max(1, math.ceil(HEIGHT / cell_size))
+        self.blocked = [[False] * self.cols for _ in range(self.rows)]
+        for wall in walls:
+            for cx in range(max(0, wall.left // cell_size), min(self.cols, (wall.right - 1) // cell_size + 1)):
+                for cy in range(max(0, wall.top // cell_size), min(self.rows, (wall.bottom - 1) // cell_size + 1)):
+                    self.blocked[cy][cx] = True
+        self.target_cell = None
+        self.distance = None
+        self.flow = [[None] * self.cols for _ in range(self.rows)]
+        self.rebuilds = 0
+
+    def cell_of(self, pos):
+        cx = min(max(int(pos[0] // self.cell_size), 0), self.cols - 1)
+        cy = min(max(int(pos[1] // self.cell_size), 0), self.rows - 1)
+        return cx, cy
+
+    def update(self, target_pos):
+        cell = self.cell_of(target_pos)
+        if cell == self.target_cell:
             return False
-    return True
+        self.target_cell = cell
+        self.rebuilds += 1
+
+        # Дейкстра от клетки игрока; клетки со стенами проходимы, но дорого
+        inf = math.inf
+        distance = [[inf] * self.cols for _ in range(self.rows)]
+        distance[cell[1]][cell[0]] = 0
+        queue = [(0, cell[0], cell[1])]
+        while queue:
+            d, cx, cy = heapq.heappop(queue)
+            if d > distance[cy][cx]:
+                continue
+            for dx, dy in self.NEIGHBOURS:
+                nx, ny = cx + dx, cy + dy
+                if not (0 <= nx < self.cols and 0 <= ny < self.rows):
+                    continue
+                if dx and dy and (self.blocked[cy][nx] or self.blocked[ny][cx]):
+                    continue
+                step = 1.414 if dx and dy else 1
+                if self.blocked[ny][nx]:
+                    step *= self.WALL_COST
+                nd = d + step
+                if nd < distance[ny][nx]:
+                    distance[ny][nx] = nd
+                    heapq.heappush(queue, (nd, nx, ny))
+        self.distance = distance
+
+        for cy in range(self.rows):
+            for cx in range(self.cols):
+                best = None
+                best_distance = distance[cy][cx]
+                for dx, dy in self.NEIGHBOURS:
+                    nx, ny = cx + dx, cy + dy
+                    if 0 <= nx < self.cols and 0 <= ny < self.rows and distance[ny][nx] < best_distance:
+                        if dx and dy and (self.blocked[cy][nx] or self.blocked[ny][cx]):
+                            continue
+                        best = (dx, dy)
+                        best_distance = distance[ny][nx]
+                self.flow[cy][cx] = pygame.Vector2(best).normalize() if best else None
+        return True
+
+    def sample(self, pos):
+        cx, cy = self.cell_of(pos)
+        return self.flow[cy][cx]
+
 
 class Player(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.image = pygame.image.load("Player.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (50, 50))
+        self.image = assets.image("Player.png", (50, 50))
         self.rect = self.image.get_rect(center=(x, y))
         self.speed = 6
         self.ammo = 6
@@ -62,11 +798,11 @@ class Player(pygame.sprite.Sprite):
         self.weapons = ["pistol", "shotgun"]
         self.unlocked_weapons = ["pistol", "shotgun"]
         self.weapon_images = {
-            "pistol": pygame.transform.scale(pygame.image.load("pistol.png"), (40, 15)),
-            "shotgun": pygame.transform.scale(pygame.image.load("shotgun.png"), (int(screen_width // 16), int(scale_factor * 25))),
-            "smg": pygame.transform.scale(pygame.image.load("smg.png"), (int(screen_width // 12), int(scale_factor * 15))),
-            "laser": pygame.transform.scale(pygame.image.load("laser.png"), (int(screen_width // 14), int(scale_factor * 18))),
-            "rocket": pygame.transform.scale(pygame.image.load("rocket.png"), (int(screen_width // 16), int(scale_factor * 25)))
+            "pistol": assets.image("pistol.png", (40, 15)),
+            "shotgun": assets.image("shotgun.png", (int(screen_width // 16), int(scale_factor * 25))),
+            "smg": assets.image("smg.png", (int(screen_width // 12), int(scale_factor * 15))),
+            "laser": assets.image("laser.png", (int(screen_width // 14), int(scale_factor * 18))),
+            "rocket": assets.image("rocket.png", (int(screen_width // 16), int(scale_factor * 25)))
         }
         self.weapon_offset = 25
         self.invincible_time = 0
@@ -86,6 +822,7 @@ class Player(pygame.sprite.Sprite):
         self.perk_options = []
         self.bullet_bounce = False
         self.extra_projectiles = False
+        self.laser_pierce = 3
         self.crit_chance = 0.0
         self.DodgePlus = 0
         self.reload_time = 0
@@ -94,12 +831,9 @@ class Player(pygame.sprite.Sprite):
         self.chips = 0
         PLAYER_SIZE = (60, 60)
 
-        def load_and_scale(path, size):
-            return pygame.transform.scale(pygame.image.load(path).convert_alpha(), size)
-
         self.animations = {
-            "idle": [load_and_scale(f"assets/player/idle_{i}.png", PLAYER_SIZE) for i in range(4)],
-            "run": [load_and_scale(f"assets/player/run_{i}.png", PLAYER_SIZE) for i in range(4)]
+            "idle": [assets.image(f"assets/player/idle_{i}.png", PLAYER_SIZE) for i in range(4)],
+            "run": [assets.image(f"assets/player/run_{i}.png", PLAYER_SIZE) for i in range(4)]
         }
         self.animation_state = "idle"
         self.animation_index = 0
@@ -109,6 +843,8 @@ class Player(pygame.sprite.Sprite):
     def update(self, keys, walls, current_time):
         if not self.alive:
             return
+        if not isinstance(walls, WallGrid):
+            walls = WallGrid(walls)
 
         if self.dodging:
 
@@ -121,8 +857,8 @@ class Player(pygame.sprite.Sprite):
                 self.rotation_angle = self.rotation_angle % 360
 
 
-                self.rect.x += self.direction.x * 10
-                self.rect.y += self.direction.y * 10
+                walls.move_and_slide(self.rect, self.direction.x * 10 * STEP_SCALE,
+                                     self.direction.y * 10 * STEP_SCALE)
             else:
 
                 self.dodging = False
@@ -130,7 +866,6 @@ class Player(pygame.sprite.Sprite):
 
         else:
 
-            old_rect = self.rect.copy()
             self.direction = pygame.Vector2(0, 0)
             if keys[pygame.K_w]: self.direction.y = -1
             if keys[pygame.K_s]: self.direction.y = 1
@@ -141,21 +876,15 @@ class Player(pygame.sprite.Sprite):
                 self.direction.normalize_ip()
 
 
-            self.rect.x += self.direction.x * self.speed
-            self.rect.y += self.direction.y * self.speed
-
-
-            for wall in walls:
-                if self.rect.colliderect(wall):
-                    self.rect = old_rect
-                    break
+            walls.move_and_slide(self.rect, self.direction.x * self.speed * STEP_SCALE,
+                                 self.direction.y * self.speed * STEP_SCALE)
 
         if self.direction.length() == 0:
             self.animation_state = "idle"
         else:
             self.animation_state = "run"
 
-        self.animation_timer += 1
+        self.animation_timer += STEP_SCALE
         if self.animation_timer >= 6:
             self.animation_index = (self.animation_index + 1) % len(self.animations[self.animation_state])
             self.animation_timer = 0
@@ -168,7 +897,7 @@ class Player(pygame.sprite.Sprite):
 
 
         if keys[pygame.K_SPACE] and not self.dodging and current_time - self.dodge_cooldown > 1000 - self.DodgePlus:
-            self.dodge()
+            self.dodge(walls)
             self.dodge_cooldown = current_time
 
 
@@ -189,7 +918,7 @@ class Player(pygame.sprite.Sprite):
         self.xp -= self.xp_to_next
         self.xp_to_next = int(self.xp_to_next * 1.5)
         self.choosing_perk = True
-        self.perk_options = random.sample([
+        self.perk_options = streams.combat.sample([
             "+1 Max HP", "+10% Speed", "+1 Dodge",
             "Faster Reload", "+20% Crit Chance"
         ], 3)
@@ -208,20 +937,23 @@ class Player(pygame.sprite.Sprite):
         self.perks.append(perk)
         self.choosing_perk = False
 
-    def dodge(self):
-        self.invincible_time = pygame.time.get_ticks()
+    def dodge(self, walls=()):
+        if not isinstance(walls, WallGrid):
+            walls = WallGrid(walls)
+        self.invincible_time = now()
         self.dodging = True
-        self.dodge_start_time = pygame.time.get_ticks()
+        self.dodge_start_time = now()
 
-        self.rect.x += self.direction.x * 25
-        self.rect.y += self.direction.y * 25
+        walls.move_and_slide(self.rect, self.direction.x * 25, self.direction.y * 25)
 
-    def draw_weapon(self, surface, mouse_pos):
+    def draw_weapon(self, surface, mouse_pos, offset=(0, 0), center=None):
         current_weapon_name = self.unlocked_weapons[self.current_weapon]
         weapon_image = self.weapon_images[current_weapon_name]
+        # center — интерполированный центр тела, чтобы оружие не дрожало относительно спрайта
+        center_x, center_y = self.rect.center if center is None else center
 
-        dx = mouse_pos[0] - self.rect.centerx
-        dy = mouse_pos[1] - self.rect.centery
+        dx = mouse_pos[0] - center_x
+        dy = mouse_pos[1] - center_y
         angle = math.degrees(math.atan2(dy, dx))
 
         rotated_image = pygame.transform.rotate(weapon_image, -angle)
@@ -229,56 +961,52 @@ class Player(pygame.sprite.Sprite):
 
         offset_x = math.cos(math.radians(angle)) * self.weapon_offset
         offset_y = math.sin(math.radians(angle)) * self.weapon_offset
-        weapon_pos = (self.rect.centerx + offset_x - rotated_rect.width // 2,
-                      self.rect.centery + offset_y - rotated_rect.height // 2)
+        weapon_pos = (center_x + offset_x - rotated_rect.width // 2 + offset[0],
+                      center_y + offset_y - rotated_rect.height // 2 + offset[1])
 
-        surface.blit(rotated_image, weapon_pos)
+        return surface.blit(rotated_image, weapon_pos)
 
-    def shoot(self, bullets, target_pos):
+    def shoot(self, bullets, target_pos, raycaster=None):
         weapon = self.unlocked_weapons[self.current_weapon]
 
         if weapon == "shotgun":
             if self.ammo >= 3 and not self.reloading:
-                shoot_sound.play()
+                play_sound("shoot")
                 self.ammo -= 3
 
                 for _ in range(8):
-                    spread = random.uniform(-15, 15)
+                    spread = streams.combat.uniform(-15, 15)
                     angle = math.atan2(target_pos[1] - self.rect.centery, target_pos[0] - self.rect.centerx)
                     angle += math.radians(spread)
                     dx = math.cos(angle) * 10
                     dy = math.sin(angle) * 10
-                    bullet = Bullet(self.rect.centerx, self.rect.centery,
-                                    (self.rect.centerx + dx * 10, self.rect.centery + dy * 10),
-                                    "player", is_shotgun=True)
-                    bullet.speed = 20
-                    bullet.piercing = False
-                    bullets.add(bullet)
+                    bullets.spawn(self.rect.centerx, self.rect.centery,
+                                  (self.rect.centerx + dx * 10, self.rect.centery + dy * 10),
+                                  "player", is_shotgun=True)
 
                 angle_back = math.atan2(self.rect.centery - target_pos[1], self.rect.centerx - target_pos[0])
-                self.rect.x += int(math.cos(angle_back) * 10)
-                self.rect.y += int(math.sin(angle_back) * 10)
+                walls = Room.current_room.wall_grid if Room.current_room else WallGrid(())
+                walls.move_and_slide(self.rect, int(math.cos(angle_back) * 10), int(math.sin(angle_back) * 10))
+                events.emit("recoil", math.cos(angle_back) * 8, math.sin(angle_back) * 8)
 
             elif self.ammo < 3 and not self.reloading:
                 self.reload()
 
         elif weapon == "smg":
             if self.ammo > 0 and not self.reloading:
-                shoot_sound.play()
+                play_sound("shoot")
                 for _ in range(2):
-                    spread = random.uniform(-0.7, 0.7)
+                    spread = streams.combat.uniform(-0.7, 0.7)
                     angle = math.atan2(target_pos[1] - self.rect.centery, target_pos[0] - self.rect.centerx) + spread
                     dx = math.cos(angle) * 3
                     dy = math.sin(angle) * 3
-                    bullet = Bullet(self.rect.centerx, self.rect.centery,
-                                    (self.rect.centerx + dx, self.rect.centery + dy),"player", is_shotgun=False)
-                    bullets.add(bullet)
+                    bullets.spawn(self.rect.centerx, self.rect.centery,
+                                  (self.rect.centerx + dx, self.rect.centery + dy), "player", is_shotgun=False)
 
-                if random.random() < 0.3:
-                    extra_bullet = Bullet(self.rect.centerx, self.rect.centery,
-                                          (self.rect.centerx + dx, self.rect.centery + dy),
-                                          "player", is_shotgun=False)
-                    bullets.add(extra_bullet)
+                if streams.combat.random() < 0.3:
+                    bullets.spawn(self.rect.centerx, self.rect.centery,
+                                  (self.rect.centerx + dx, self.rect.centery + dy),
+                                  "player", is_shotgun=False)
 
                 self.ammo -= 1
             else:
@@ -286,16 +1014,21 @@ class Player(pygame.sprite.Sprite):
 
         elif weapon == "laser":
             if self.ammo > 0 and not self.reloading:
-                shoot_sound.play()
+                play_sound("shoot")
                 angle = math.atan2(target_pos[1] - self.rect.centery, target_pos[0] - self.rect.centerx)
-                dx = math.cos(angle)
-                dy = math.sin(angle)
-                laser_end = pygame.Vector2(self.rect.centerx + dx * 1000, self.rect.centery + dy * 1000)
-
-                pygame.draw.line(screen, (0, 255, 255), self.rect.center, laser_end, 4)
-                for enemy in list(Room.current_room.enemies):
-                    if pygame.Rect(enemy.rect).clipline(self.rect.center, laser_end):
-                        enemy.take_damage(self)
+                reach = math.hypot(WIDTH, HEIGHT)
+                laser_end = (self.rect.centerx + math.cos(angle) * reach, self.rect.centery + math.sin(angle) * reach)
+
+                room = Room.current_room
+                if raycaster is None:
+                    raycaster = Raycaster(SpatialHash())
+                hits, beam_end = raycaster.cast(self.rect.center, laser_end, room, self.laser_pierce)
+                for _, _, target, layer in hits:
+                    if layer == "enemies":
+                        target.take_damage(self)
+                    elif layer == "barrels":
+                        target.take_damage(self, room)
+                events.emit("laser", self.rect.center, beam_end)
 
                 self.ammo -= 1
             else:
@@ -303,42 +1036,38 @@ class Player(pygame.sprite.Sprite):
 
         elif weapon == "rocket":
             if self.ammo > 0 and not self.reloading:
-                shoot_sound.play()
-                bullet = Bullet(self.rect.centerx, self.rect.centery, target_pos, "player", self.speed * 0.5)
-                bullet.image.fill((255, 120, 0))
-                bullet.explodes = True
-                bullets.add(bullet)
+                play_sound("shoot")
+                bullets.spawn(self.rect.centerx, self.rect.centery, target_pos, "player", self.speed * 0.5,
+                              explodes=True, color=(255, 120, 0))
                 self.ammo -= 1
             else:
                 self.reload()
         else:
             if self.ammo > 0 and not self.reloading:
-                shoot_sound.play()
-                bullet = Bullet(self.rect.centerx, self.rect.centery, target_pos, "player", self.speed)
-                bullets.add(bullet)
+                play_sound("shoot")
+                bullets.spawn(self.rect.centerx, self.rect.centery, target_pos, "player", self.speed)
                 self.ammo -= 1
             elif self.ammo == 0 and not self.reloading:
                 self.reload()
 
     def reload(self):
         self.reloading = True
-        self.last_reload_time = pygame.time.get_ticks()
-        reload_sound.play()
+        self.last_reload_time = now()
+        play_sound("reload")
 
     def draw_current_weapon(surface, player, x, y):
-        font = pygame.font.Font(None, 30)
-        weapon_text = font.render(f"Weapon: {player.weapons[player.current_weapon]}", True, (255, 255, 255))
+        weapon_text = text_cache.render(f"Weapon: {player.unlocked_weapons[player.current_weapon]}", 30, (255, 255, 255))
         surface.blit(weapon_text, (x, y))
 
     def take_damage(self):
         if self.invincible_time == 0:
-            hit_sound.play()
+            play_sound("player_hit")
             self.health -= 1
             self.just_took_damage = True
-            self.damage_effect_time = pygame.time.get_ticks()
-            shake_start_time = pygame.time.get_ticks()
+            self.damage_effect_time = now()
+            events.emit("shake", 300, 5)
             if self.health <= 0:
-                death_sound.play()
+                play_sound("player_death")
                 self.alive = False
                 self.room.room_count = 0
 
@@ -353,57 +1082,123 @@ class Player(pygame.sprite.Sprite):
     def switch_weapon(self, direction):
         self.current_weapon = (self.current_weapon + direction) % len(self.unlocked_weapons)
 
-class BloodParticle(pygame.sprite.Sprite):
-    def __init__(self, x, y, dx, dy, color=(255, 0, 0)):
-        super().__init__()
-        self.size = random.randint(4, 8)
-        self.image = pygame.Surface((self.size, self.size), pygame.SRCALPHA)
-        self.color = color
-        pygame.draw.circle(self.image, self.color, (self.size // 2, self.size // 2), self.size // 2)
-        self.rect = self.image.get_rect(center=(x, y))
-        self.dx = dx
-        self.dy = dy
-        self.gravity = 0.1
-        self.life_time = random.randint(30, 60)
-        self.alpha = 255
+GORE_COLORS = ((255, 0, 0), (200, 0, 0), (120, 0, 0))
+
+
+class ParticleSystem:
+    CIRCLE = 0
+    SQUARE = 1
+
+    def __init__(self, capacity=4096, alpha_buckets=16):
+        self.capacity = capacity
+        self.alpha_buckets = alpha_buckets
+        self.pos = np.zeros((capacity, 2), dtype=np.float32)
+        self.vel = np.zeros((capacity, 2), dtype=np.float32)
+        self.gravity = np.zeros(capacity, dtype=np.float32)
+        self.life = np.zeros(capacity, dtype=np.float32)
+        self.alpha = np.zeros(capacity, dtype=np.float32)
+        self.fade = np.zeros(capacity, dtype=np.float32)
+        self.size = np.zeros(capacity, dtype=np.int32)
+        self.style = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.head = 0
+        self.evicted = 0
+        self.styles = []
+        self.style_ids = {}
+        self.stamps = {}
+        self.rng = streams.particles
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+    def _style_id(self, shape, color):
+        key = (shape, tuple(color))
+        if key not in self.style_ids:
+            self.style_ids[key] = len(self.styles)
+            self.styles.append(key)
+        return self.style_ids[key]
+
+    def _allocate(self, count):
+        # Кольцевой буфер: при переполнении перезаписываются самые старые частицы
+        count = min(count, self.capacity)
+        slots = (self.head + np.arange(count)) % self.capacity
+        self.evicted += int(np.count_nonzero(self.alive[slots]))
+        self.head = (self.head + count) % self.capacity
+        return slots
+
+    def emit(self, x, y, dx, dy, color=(255, 0, 0), size=None, life=None,
+             gravity=0.1, fade=5, shape=CIRCLE):
+        slot = self._allocate(1)[0]
+        self.pos[slot] = (x, y)
+        self.vel[slot] = (dx, dy)
+        self.gravity[slot] = gravity
+        self.life[slot] = life if life is not None else self.rng.integers(30, 61)
+        self.alpha[slot] = 255
+        self.fade[slot] = fade
+        self.size[slot] = size if size is not None else self.rng.integers(4, 9)
+        self.style[slot] = self._style_id(shape, color)
+        self.alive[slot] = True
+
+    def emit_burst(self, x, y, count, spread, colors=((255, 0, 0),), size_range=(4, 8),
+                   life_range=(30, 60), gravity=0.1, fade=5, shape=CIRCLE):
+        slots = self._allocate(count)
+        n = len(slots)
+        self.pos[slots] = (x, y)
+        self.vel[slots] = self.rng.uniform(-spread, spread, (n, 2))
+        self.gravity[slots] = gravity
+        self.life[slots] = self.rng.integers(life_range[0], life_range[1] + 1, n)
+        self.alpha[slots] = 255
+        self.fade[slots] = fade
+        self.size[slots] = self.rng.integers(size_range[0], size_range[1] + 1, n)
+        style_ids = np.array([self._style_id(shape, color) for color in colors], dtype=np.int32)
+        self.style[slots] = style_ids[self.rng.integers(0, len(style_ids), n)]
+        self.alive[slots] = True
 
     def update(self):
-        self.rect.x += self.dx
-        self.rect.y += self.dy
-        self.dy += self.gravity
-
-        self.life_time -= 1
-        self.alpha -= 5
-
-        self.image = pygame.Surface((self.size, self.size), pygame.SRCALPHA)
-        pygame.draw.circle(self.image, self.color, (self.size // 2, self.size // 2), self.size // 2)
-        self.image.set_alpha(self.alpha)
-
-        if self.life_time <= 0 or self.alpha <= 0:
-            self.kill()
-
-class WindParticle(pygame.sprite.Sprite):
-    def __init__(self, x, y, direction):
-        super().__init__()
-        self.image = pygame.Surface((4, 4), pygame.SRCALPHA)
-        self.image.fill((200, 200, 255))
-        self.rect = self.image.get_rect(center=(x, y))
-        self.velocity = direction * random.uniform(1.0, 2.5)
-        self.life = random.randint(30, 60)
-
-    def update(self):
-        self.rect.x += self.velocity.x
-        self.rect.y += self.velocity.y
-        self.life -= 1
-        if self.life <= 0:
-            self.kill()
+        idx = np.flatnonzero(self.alive)
+        if not len(idx):
+            return
+        scale = STEP_SCALE
+        self.pos[idx] += self.vel[idx] * scale
+        self.vel[idx, 1] += self.gravity[idx] * scale
+        self.life[idx] -= scale
+        self.alpha[idx] -= self.fade[idx] * scale
+        self.alive[idx] = (self.life[idx] > 0) & (self.alpha[idx] > 0)
+
+    def clear(self):
+        self.alive[:] = False
+
+    def _stamp(self, style, size, bucket):
+        key = (style, size, bucket)
+        stamp = self.stamps.get(key)
+        if stamp is None:
+            shape, color = self.styles[style]
+            stamp = pygame.Surface((size, size), pygame.SRCALPHA)
+            if shape == ParticleSystem.CIRCLE:
+                pygame.draw.circle(stamp, color, (size // 2, size // 2), size // 2)
+            else:
+                stamp.fill(color)
+            stamp.set_alpha(min(255, (bucket + 1) * 256 // self.alpha_buckets))
+            self.stamps[key] = stamp
+        return stamp
+
+    def draw(self, surface, return_rects=False, offset=(0, 0)):
+        idx = np.flatnonzero(self.alive)
+        if not len(idx):
+            return []
+        sizes = self.size[idx]
+        buckets = np.clip(self.alpha[idx] * self.alpha_buckets // 256, 0, self.alpha_buckets - 1).astype(np.int32)
+        corners = (self.pos[idx] - (sizes // 2)[:, None] + offset).astype(np.int32)
+        stamp = self._stamp
+        return surface.blits([(stamp(st, sz, b), (x, y)) for st, sz, b, (x, y) in
+                              zip(self.style[idx].tolist(), sizes.tolist(), buckets.tolist(), corners.tolist())],
+                             doreturn=return_rects)
 
 
 class Trader(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.image = pygame.image.load("Trader.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (100, 120))
+        self.image = assets.image("Trader.png", (100, 120))
         self.rect = self.image.get_rect(center=(x, y))
         self.weapon_options = ["smg", "laser", "rocket"]
         self.prices = [5, 7, 10]
@@ -416,14 +1211,13 @@ class Trader(pygame.sprite.Sprite):
                 player.chips -= self.prices[index]
                 self.prices[index] = 0
                 self.weapon_options[index] = "SOLD"
-                buy_sound.play()
+                play_sound("buy")
 
 
 class SpikeTrap(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.image = pygame.image.load("Spike_Trap.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (80, 80))
+        self.image = assets.image("Spike_Trap.png", (80, 80))
         self.rect = self.image.get_rect(topleft=(x, y))
         self.damage_timer = 0
 
@@ -437,8 +1231,7 @@ class SpikeTrap(pygame.sprite.Sprite):
 class ExplosiveBarrel(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.image = pygame.image.load("Bochka.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (60, 80))
+        self.image = assets.image("Bochka.png", (60, 80))
         self.rect = self.image.get_rect(center=(x, y))
         self.health = 2
 
@@ -447,56 +1240,191 @@ class ExplosiveBarrel(pygame.sprite.Sprite):
         if self.health <= 0:
             self.explode(player, room)
 
-    def explode(self, player, room):
-        explosion_radius = 300
-        explosion_center = pygame.Vector2(self.rect.center)
-        for enemy in list(room.enemies):
-            if explosion_center.distance_to(enemy.rect.center) <= explosion_radius:
-                enemy.take_damage(player)
-
-        for _ in range(20):
-            dx = random.uniform(-3, 3)
-            dy = random.uniform(-3, 3)
-            blood_particles.add(BloodParticle(self.rect.centerx, self.rect.centery, dx, dy, (255, 140, 0)))
+    def rupture(self, room):
+        self.health = 0
+        blood_particles.emit_burst(self.rect.centerx, self.rect.centery, 20, 3, colors=((255, 140, 0),))
         self.kill()
+        room.invalidate_static()
 
-
-class Bullet(pygame.sprite.Sprite):
-    def __init__(self, x, y, target_pos, shooter, is_shotgun=False):
-        super().__init__()
-        self.image = pygame.Surface((10, 10))
-        self.image.fill((255, 255, 0))
-        self.rect = self.image.get_rect(center=(x, y))
-        self.speed = 10
-        self.shooter = shooter
-        self.origin = pygame.Vector2(x, y)
-        self.is_shotgun = is_shotgun
-        self.piercing = False
-        self.explodes = False
-
+    def explode(self, player, room):
+        self.rupture(room)
+        explosions.explode(self.rect.center, player, room, ExplosionResolver.BARREL_RADIUS,
+                           ExplosionResolver.BARREL_DAMAGE, hurts_player=True)
+
+
+class ProjectileStore:
+    PLAYER = 0
+    ENEMY = 1
+    OWNERS = ("player", "enemy")
+    PIERCING = 1
+    EXPLODES = 2
+    SHOTGUN = 4
+    DRIFT = 8
+    SIZE = 10
+    SPEED = 10
+    MAX_AGE = 600
+    DEFAULT_COLOR = (255, 255, 0)
+
+    def __init__(self, capacity=256):
+        self.capacity = 0
+        self.pos = np.zeros((0, 2))
+        self.prev = np.zeros((0, 2))
+        self.vel = np.zeros((0, 2))
+        self.origin = np.zeros((0, 2))
+        self.age = np.zeros(0, dtype=np.float32)
+        self.owner = np.zeros(0, dtype=np.int8)
+        self.flags = np.zeros(0, dtype=np.int8)
+        self.color = np.zeros(0, dtype=np.int16)
+        self.generation = np.zeros(0, dtype=np.int64)
+        self.alive = np.zeros(0, dtype=bool)
+        self.colors = []
+        self.color_ids = {}
+        self.stamps = []
+        self.wind = np.zeros(2)
+        self.drift = False
+        self.culled = 0
+        self._grow(capacity)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        for name in ("pos", "prev", "vel", "origin", "age", "owner", "flags", "color", "generation", "alive"):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros((extra,) + array.shape[1:], dtype=array.dtype)]))
+        self.capacity = capacity
+
+    def _color_id(self, color):
+        color = tuple(color)
+        if color not in self.color_ids:
+            self.color_ids[color] = len(self.colors)
+            self.colors.append(color)
+            stamp = pygame.Surface((self.SIZE, self.SIZE))
+            stamp.fill(color)
+            self.stamps.append(stamp)
+        return self.color_ids[color]
+
+    def set_room(self, room):
+        # Ветер читается один раз при входе в комнату, а не в конструкторе каждой пули
+        self.drift = room.event == "bullet_drift"
+        self.wind[:] = tuple(room.wind_direction)
+
+    def spawn(self, x, y, target_pos, shooter, is_shotgun=False, explodes=False, color=DEFAULT_COLOR):
+        free = np.flatnonzero(~self.alive)
+        if not len(free):
+            free = [self.capacity]
+            self._grow(self.capacity * 2)
+        slot = free[0]
 
         angle = math.atan2(target_pos[1] - y, target_pos[0] - x)
-        if hasattr(Room, 'current_room') and Room.current_room.event == "bullet_drift":
-            angle += random.uniform(-0.25, 0.25)
-        self.dx = math.cos(angle) * self.speed
-        self.dy = math.sin(angle) * self.speed
-        if hasattr(Room, 'current_room') and Room.current_room.event == "bullet_drift":
-            wind = Room.current_room.wind_direction
-            self.dx += wind.x
-            self.dy += wind.y
-
+        flags = 0
+        if self.drift:
+            angle += streams.combat.uniform(-0.25, 0.25)
+            flags |= self.DRIFT
+        if is_shotgun:
+            flags |= self.SHOTGUN
+        if explodes:
+            flags |= self.EXPLODES
+        self.pos[slot] = self.prev[slot] = self.origin[slot] = (x, y)
+        self.vel[slot] = (math.cos(angle) * self.SPEED, math.sin(angle) * self.SPEED)
+        self.age[slot] = 0
+        self.owner[slot] = self.OWNERS.index(shooter)
+        self.flags[slot] = flags
+        self.color[slot] = self._color_id(color)
+        self.generation[slot] += 1
+        self.alive[slot] = True
+        return Bullet(self, slot)
 
     def update(self):
-        self.rect.x += self.dx
-        self.rect.y += self.dy
-        if not (0 <= self.rect.x <= WIDTH and 0 <= self.rect.y <= HEIGHT):
-            self.kill()
+        idx = np.flatnonzero(self.alive)
+        if not len(idx):
+            return
+        step = self.vel[idx]
+        drifting = (self.flags[idx] & self.DRIFT) != 0
+        step[drifting] += self.wind
+        self.pos[idx] += step * STEP_SCALE
+        self.age[idx] += STEP_SCALE
+
+        corner = self.pos[idx] - self.SIZE // 2
+        inside = ((corner >= 0) & (corner <= (WIDTH, HEIGHT))).all(axis=1) & (self.age[idx] < self.MAX_AGE)
+        self.culled += int(np.count_nonzero(~inside))
+        self.alive[idx] = inside
+
+    def snapshot(self):
+        self.prev[:] = self.pos
+
+    def clear(self):
+        self.alive[:] = False
+
+    def handles(self, owner=None):
+        mask = self.alive if owner is None else self.alive & (self.owner == owner)
+        return [Bullet(self, slot) for slot in np.flatnonzero(mask).tolist()]
+
+    def draw(self, surface, alpha=1.0, offset=(0, 0), owner=None):
+        idx = np.flatnonzero(self.alive if owner is None else self.alive & (self.owner == owner))
+        if not len(idx):
+            return []
+        pos = self.prev[idx] + (self.pos[idx] - self.prev[idx]) * alpha
+        corners = (pos - self.SIZE // 2 + offset).astype(np.int32)
+        colors = self.color[idx]
+        rects = []
+        # Один blits на цвет: все пули одного цвета рисуются одной пачкой
+        for color in np.unique(colors).tolist():
+            stamp = self.stamps[color]
+            rects += surface.blits([(stamp, corner) for corner in corners[colors == color].tolist()])
+        return rects
+
+
+class Bullet:
+    __slots__ = ("store", "slot", "generation")
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+        self.generation = int(store.generation[slot])
+
+    def alive(self):
+        return bool(self.store.alive[self.slot]) and self.store.generation[self.slot] == self.generation
+
+    def kill(self):
+        if self.alive():
+            self.store.alive[self.slot] = False
+
+    def has_flag(self, flag):
+        return bool(self.store.flags[self.slot] & flag)
+
+    @property
+    def rect(self):
+        size = ProjectileStore.SIZE
+        x, y = self.store.pos[self.slot]
+        return pygame.Rect(int(x) - size // 2, int(y) - size // 2, size, size)
+
+    @property
+    def origin(self):
+        return pygame.Vector2(*self.store.origin[self.slot])
+
+    @property
+    def shooter(self):
+        return ProjectileStore.OWNERS[self.store.owner[self.slot]]
+
+    @property
+    def piercing(self):
+        return self.has_flag(ProjectileStore.PIERCING)
+
+    @property
+    def explodes(self):
+        return self.has_flag(ProjectileStore.EXPLODES)
+
+    @property
+    def is_shotgun(self):
+        return self.has_flag(ProjectileStore.SHOTGUN)
 
     def check_collision(self, target, player):
         if self.rect.colliderect(target.rect):
             if hasattr(target, 'take_damage'):
                 damage = 1
-                if player.crit_chance > 0 and random.random() < player.crit_chance:
+                if player.crit_chance > 0 and streams.combat.random() < player.crit_chance:
                     damage *= 2
                 for _ in range(damage):
                     target.take_damage(player)
@@ -514,11 +1442,11 @@ class Bullet(pygame.sprite.Sprite):
                     target.take_damage(player)
                     self.create_blood_splash(target)
                 elif distance < 200:
-                    if random.random() < 0.5:
+                    if streams.combat.random() < 0.5:
                         target.take_damage(player)
                         self.create_blood_splash(target)
                 elif distance < 200:
-                    if random.random() < 0.5:
+                    if streams.combat.random() < 0.5:
                         target.take_damage(player)
                         self.create_blood_splash(target)
             else:
@@ -527,90 +1455,141 @@ class Bullet(pygame.sprite.Sprite):
             self.kill()
 
     def explode_area(self, player):
-        flash = pygame.Surface((WIDTH, HEIGHT))
-        flash.set_alpha(80)
-        flash.fill((255, 200, 100))
-        screen.blit(flash, (0, 0))
-        explosion_radius = 300
-        explosion_center = pygame.Vector2(self.rect.center)
-        for enemy in list(Room.current_room.enemies):
-            if explosion_center.distance_to(enemy.rect.center) <= explosion_radius:
-                enemy.take_damage(player)
-        for _ in range(15):
-            dx = random.uniform(-3, 3)
-            dy = random.uniform(-3, 3)
-            blood_particles.add(BloodParticle(self.rect.centerx, self.rect.centery, dx, dy, (255, 140, 0)))
-        for enemy in list(Room.current_room.enemies):
-            if explosion_center.distance_to(enemy.rect.center) <= explosion_radius:
-                enemy.take_damage(player)
-                knockback = pygame.Vector2(enemy.rect.center) - explosion_center
-                if knockback.length() > 0:
-                    knockback.normalize_ip()
-                    enemy.rect.x += int(knockback.x * 40)
-                    enemy.rect.y += int(knockback.y * 40)
-
+        events.emit("flash", (255, 200, 100), 80)
+        blood_particles.emit_burst(self.rect.centerx, self.rect.centery, 15, 3, colors=((255, 140, 0),))
+        explosions.explode(self.rect.center, player, Room.current_room,
+                           ExplosionResolver.ROCKET_RADIUS, ExplosionResolver.ROCKET_DAMAGE, knockback=True)
 
     def create_blood_splash(self, target):
+        blood_particles.emit_burst(target.rect.centerx, target.rect.centery, 10, 2)
+
+
+class ExplosionResolver:
+    ENEMY = 0
+    BARREL = 1
+    PLAYER = 2
+    BOSS = 3
+    ROCKET_RADIUS = 300
+    ROCKET_DAMAGE = 2
+    BARREL_RADIUS = 300
+    BARREL_DAMAGE = 2
+    FALLOFF = 0.5
+    PLAYER_RADIUS = 0.5
+    # Отбрасывание, как и раньше, только от ракеты, только обычных врагов и на полные 40 пикселей
+    KNOCKBACK = 40
+
+    def __init__(self):
+        self.explosions = 0
+        self.longest_chain = 0
+
+    @staticmethod
+    def build_index(player, room):
+        targets = [enemy for enemy in room.enemies if enemy.health > 0]
+        kinds = [ExplosionResolver.ENEMY] * len(targets)
+        if room.boss and room.boss.health > 0:
+            targets.append(room.boss)
+            kinds.append(ExplosionResolver.BOSS)
+        barrels = [barrel for barrel in room.barrels if barrel.health > 0]
+        objects = targets + barrels + [player]
+        kinds = np.array(kinds + [ExplosionResolver.BARREL] * len(barrels) + [ExplosionResolver.PLAYER])
+        centers = np.array([obj.rect.center for obj in objects], dtype=float)
+        return objects, kinds, centers
+
+    def explode(self, center, player, room, radius, damage, hurts_player=False, knockback=False):
+        # Один индекс на всю цепочку; каждый взрыв — один векторный запрос по радиусу,
+        # взорвавшиеся бочки встают в очередь (обход в ширину, без рекурсии)
+        objects, kinds, centers = self.build_index(player, room)
+        queue = deque([(center, radius, damage, hurts_player, knockback)])
+        player_hit = False
+        chain = 0
+        while queue:
+            center, radius, damage, hurts_player, knockback = queue.popleft()
+            chain += 1
+            offsets = centers - center
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+            inside = np.flatnonzero(distances <= radius)
+            falloff = 1 - self.FALLOFF * distances[inside] / radius
+            amounts = np.maximum(1, np.rint(damage * falloff)).astype(int)
+
+            for index, amount in zip(inside.tolist(), amounts.tolist()):
+                obj = objects[index]
+                kind = kinds[index]
+                if kind == self.ENEMY or kind == self.BOSS:
+                    for _ in range(amount):
+                        if obj.health <= 0:
+                            break
+                        obj.take_damage(player)
+                elif kind == self.BARREL:
+                    if obj.health <= 0:
+                        continue
+                    obj.health -= amount
+                    if obj.health <= 0:
+                        obj.rupture(room)
+                        queue.append((obj.rect.center, self.BARREL_RADIUS, self.BARREL_DAMAGE, True, False))
+                elif hurts_player and not player_hit and distances[index] <= radius * self.PLAYER_RADIUS:
+                    player_hit = True
+                    player.take_damage()
+
+            if not knockback:
+                continue
+            pushed = inside[(kinds[inside] == self.ENEMY) & (distances[inside] > 0)]
+            if len(pushed):
+                push = (offsets[pushed] / distances[pushed, None] * self.KNOCKBACK).astype(int)
+                for index, (dx, dy) in zip(pushed.tolist(), push.tolist()):
+                    objects[index].rect.move_ip(dx, dy)
+                # Следующие взрывы цепочки видят врагов уже на новых местах
+                centers[pushed] += push
 
-        for _ in range(10):
-            dx = random.uniform(-2, 2)
-            dy = random.uniform(-2, 2)
-            blood_particle = BloodParticle(target.rect.centerx, target.rect.centery, dx, dy)
-            blood_particles.add(blood_particle)
+        self.explosions += chain
+        self.longest_chain = max(self.longest_chain, chain)
 
 
-blood_particles = pygame.sprite.Group()
+blood_particles = ParticleSystem(capacity=4096)
+explosions = ExplosionResolver()
 
 class TeleportBoss(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.image = pygame.image.load("TeleportingBoss.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (70, 60))
+        self.image = assets.image("TeleportingBoss.png", (70, 60))
         self.rect = self.image.get_rect(center=(x, y))
         self.speed = 2
         self.shoot_delay = 1000
-        self.last_shot_time = pygame.time.get_ticks()
+        self.last_shot_time = now()
         self.health = 4
         self.last_tp = 0
 
     def update(self, player, bullets, current_time):
 
         if pygame.sprite.collide_rect(self, player):
+            step = self.speed * STEP_SCALE
             if self.rect.centerx < player.rect.centerx:
-                self.rect.x += self.speed
+                self.rect.x += step
             elif self.rect.centerx > player.rect.centerx:
-                self.rect.x -= self.speed
+                self.rect.x -= step
             if self.rect.centery < player.rect.centery:
-                self.rect.y += self.speed
+                self.rect.y += step
             elif self.rect.centery > player.rect.centery:
-                self.rect.y -= self.speed
+                self.rect.y -= step
 
         if current_time - self.last_shot_time >= self.shoot_delay:
             self.shoot(bullets, player.rect.center)
             self.last_shot_time = current_time
 
     def shoot(self, bullets, target_pos):
-        bullet = Bullet(self.rect.centerx, self.rect.centery, target_pos, "enemy")
-        bullets.add(bullet)
-        if pygame.time.get_ticks() - self.last_tp > 1500:
-            self.rect.center = (random.randint(100, WIDTH - 100), random.randint(100, HEIGHT - 100))
-            self.last_tp = pygame.time.get_ticks()
+        bullets.spawn(self.rect.centerx, self.rect.centery, target_pos, "enemy")
+        if now() - self.last_tp > 1500:
+            self.rect.center = (streams.combat.randint(100, WIDTH - 100), streams.combat.randint(100, HEIGHT - 100))
+            self.last_tp = now()
 
     def explode_gore(self):
-        for _ in range(50):
-            dx = random.uniform(-6, 6)
-            dy = random.uniform(-6, 6)
-            size = random.randint(3, 8)
-            color = random.choice([(255, 0, 0), (200, 0, 0), (120, 0, 0)])
-            particle = BloodParticle(self.rect.centerx, self.rect.centery, dx, dy, color)
-            particle.size = size
-            blood_particles.add(particle)
+        blood_particles.emit_burst(self.rect.centerx, self.rect.centery, 50, 6,
+                                   colors=GORE_COLORS, size_range=(3, 8))
 
     def take_damage(self, player):
-        hit_sound.play()
+        play_sound("hit")
         self.health -= 1
         if self.health <= 0:
-            death_sound.play()
+            play_sound("death")
             self.explode_gore()
             self.kill()
             player.gain_xp(10)
@@ -621,48 +1600,41 @@ class TeleportBoss(pygame.sprite.Sprite):
 class Enemy(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.image = pygame.image.load("Enemy.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (50, 50))
+        self.image = assets.image("Enemy.png", (50, 50))
         self.rect = self.image.get_rect(center=(x, y))
         self.speed = 2
         self.shoot_delay = 1000
-        self.last_shot_time = pygame.time.get_ticks()
+        self.last_shot_time = now()
         self.health = 4
 
     def update(self, player, bullets, current_time):
         if pygame.sprite.collide_rect(self, player):
+            step = self.speed * STEP_SCALE
             if self.rect.centerx < player.rect.centerx:
-                self.rect.x += self.speed
+                self.rect.x += step
             elif self.rect.centerx > player.rect.centerx:
-                self.rect.x -= self.speed
+                self.rect.x -= step
             if self.rect.centery < player.rect.centery:
-                self.rect.y += self.speed
+                self.rect.y += step
             elif self.rect.centery > player.rect.centery:
-                self.rect.y -= self.speed
+                self.rect.y -= step
 
         if current_time - self.last_shot_time >= self.shoot_delay:
             self.shoot(bullets, player.rect.center)
             self.last_shot_time = current_time
 
     def shoot(self, bullets, target_pos):
-        bullet = Bullet(self.rect.centerx, self.rect.centery, target_pos, "enemy")
-        bullets.add(bullet)
+        bullets.spawn(self.rect.centerx, self.rect.centery, target_pos, "enemy")
 
     def explode_gore(self):
-        for _ in range(50):
-            dx = random.uniform(-6, 6)
-            dy = random.uniform(-6, 6)
-            size = random.randint(3, 8)
-            color = random.choice([(255, 0, 0), (200, 0, 0), (120, 0, 0)])
-            particle = BloodParticle(self.rect.centerx, self.rect.centery, dx, dy, color)
-            particle.size = size
-            blood_particles.add(particle)
+        blood_particles.emit_burst(self.rect.centerx, self.rect.centery, 50, 6,
+                                   colors=GORE_COLORS, size_range=(3, 8))
 
     def take_damage(self, player):
-        hit_sound.play()
+        play_sound("hit")
         self.health -= 1
         if self.health <= 0:
-            death_sound.play()
+            play_sound("death")
             self.explode_gore()
             self.kill()
             player.gain_xp(2)
@@ -671,21 +1643,25 @@ class Enemy(pygame.sprite.Sprite):
 class ChasingEnemy(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.image = pygame.image.load("ChacingEnemy.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (50, 50))
+        self.image = assets.image("ChacingEnemy.png", (50, 50))
         self.rect = self.image.get_rect(center=(x, y))
         self.speed = 4
         self.shoot_delay = 1000
-        self.last_shot_time = pygame.time.get_ticks()
+        self.last_shot_time = now()
         self.health = 3
 
-    def update(self, player, bullets, current_time, walls):
+    def update(self, player, bullets, current_time, walls, flow_field=None):
         if has_line_of_sight(self.rect.center, player.rect.center, walls):
             direction = pygame.Vector2(player.rect.center) - pygame.Vector2(self.rect.center)
             if direction.length() > 0:
                 direction = direction.normalize()
-                self.rect.x += direction.x * self.speed
-                self.rect.y += direction.y * self.speed
+                self.rect.x += direction.x * self.speed * STEP_SCALE
+                self.rect.y += direction.y * self.speed * STEP_SCALE
+        elif flow_field is not None:
+            direction = flow_field.sample(self.rect.center)
+            if direction is not None:
+                self.rect.x += direction.x * self.speed * STEP_SCALE
+                self.rect.y += direction.y * self.speed * STEP_SCALE
 
         if current_time - self.last_shot_time >= self.shoot_delay:
             if has_line_of_sight(self.rect.center, player.rect.center, walls):
@@ -693,29 +1669,168 @@ class ChasingEnemy(pygame.sprite.Sprite):
                 self.last_shot_time = current_time
 
     def shoot(self, bullets, target_pos):
-        bullet = Bullet(self.rect.centerx, self.rect.centery, target_pos, "enemy")
-        bullets.add(bullet)
+        bullets.spawn(self.rect.centerx, self.rect.centery, target_pos, "enemy")
 
     def explode_gore(self):
-        for _ in range(50):
-            dx = random.uniform(-6, 6)
-            dy = random.uniform(-6, 6)
-            size = random.randint(3, 8)
-            color = random.choice([(255, 0, 0), (200, 0, 0), (120, 0, 0)])
-            particle = BloodParticle(self.rect.centerx, self.rect.centery, dx, dy, color)
-            particle.size = size
-            blood_particles.add(particle)
+        blood_particles.emit_burst(self.rect.centerx, self.rect.centery, 50, 6,
+                                   colors=GORE_COLORS, size_range=(3, 8))
 
     def take_damage(self, player):
-        hit_sound.play()
+        play_sound("hit")
         self.health -= 1
         if self.health <= 0:
-            death_sound.play()
+            play_sound("death")
             self.explode_gore()
             self.kill()
             player.gain_xp(5)
             player.chips += 2
 
+class SpatialHash:
+    LAYERS = ("player_bullets", "enemy_bullets", "enemies", "barrels", "player")
+    LAYER_COLORS = {
+        "player_bullets": (255, 255, 0),
+        "enemy_bullets": (255, 80, 80),
+        "enemies": (255, 0, 255),
+        "barrels": (255, 140, 0),
+        "player": (0, 255, 0),
+    }
+
+    def __init__(self, cell_size=100):
+        self.cell_size = cell_size
+        self.layers = {name: {} for name in self.LAYERS}
+        self.counts = dict.fromkeys(self.LAYERS, 0)
+        self.pair_tests = 0
+        self.naive_tests = 0
+
+    def clear(self):
+        for cells in self.layers.values():
+            cells.clear()
+        self.counts = dict.fromkeys(self.LAYERS, 0)
+        self.pair_tests = 0
+        self.naive_tests = 0
+
+    def cells_for(self, rect):
+        size = self.cell_size
+        for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                yield cx, cy
+
+    def insert(self, layer, obj, rect=None):
+        cells = self.layers[layer]
+        for cell in self.cells_for(obj.rect if rect is None else rect):
+            bucket = cells.get(cell)
+            if bucket is None:
+                cells[cell] = [obj]
+            else:
+                bucket.append(obj)
+        self.counts[layer] += 1
+
+    def insert_all(self, layer, objects):
+        for obj in objects:
+            self.insert(layer, obj)
+
+    def rebuild_layer(self, layer, objects):
+        self.layers[layer].clear()
+        self.counts[layer] = 0
+        self.insert_all(layer, objects)
+
+    def pairs(self, layer_a, layer_b):
+        # Отдаём только пары, которые делят хотя бы одну клетку; каждую пару один раз
+        self.naive_tests += self.counts[layer_a] * self.counts[layer_b]
+        cells_b = self.layers[layer_b]
+        seen = set()
+        for cell, items_a in list(self.layers[layer_a].items()):
+            items_b = cells_b.get(cell)
+            if not items_b:
+                continue
+            for a in items_a:
+                for b in items_b:
+                    key = (id(a), id(b))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    self.pair_tests += 1
+                    yield a, b
+
+    def draw_debug(self, surface):
+        size = self.cell_size
+        for layer, cells in self.layers.items():
+            color = self.LAYER_COLORS[layer]
+            for cx, cy in cells:
+                pygame.draw.rect(surface, color, (cx * size, cy * size, size, size), 1)
+        text = text_cache.render(f"Pair tests: {self.pair_tests} (naive {self.naive_tests})", 24, (0, 255, 0))
+        surface.blit(text, (10, HEIGHT - 90))
+
+
+class Raycaster:
+    STOP_LAYERS = ("enemies", "barrels")
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.rays = 0
+        self.cells_visited = 0
+
+    @staticmethod
+    def entry(rect, start, end):
+        clipped = rect.clipline(start, end)
+        if not clipped:
+            return None
+        point = clipped[0]
+        return math.hypot(point[0] - start[0], point[1] - start[1]), point
+
+    def refresh(self, room, layers=STOP_LAYERS):
+        # Сетку заполняет resolve_collisions прошлого тика, а выстрел приходит между тиками:
+        # перед лучом переносим цели в их текущие позиции. Босс живёт не в группе врагов,
+        # поэтому, как и в resolve_collisions, кладём его в слой врагов отдельно
+        for layer in layers:
+            objects = getattr(room, layer, None)
+            if objects is not None:
+                self.grid.rebuild_layer(layer, objects)
+            if layer == "enemies" and room.boss and room.boss.health > 0:
+                self.grid.insert(layer, room.boss)
+
+    def cast(self, start, end, room, pierce=None, layers=STOP_LAYERS, refresh=True):
+        # Попадания вдоль луча по порядку: цели до первой стены, стена закрывает список.
+        # pierce <= 0 значит, что цели не поражаются и луч идёт до стены.
+        # Возвращает (попадания, точка, где луч остановился)
+        self.rays += 1
+        if pierce is not None and pierce <= 0:
+            layers = ()
+        if refresh:
+            self.refresh(room, layers)
+        wall_hit = None
+        walls = room.wall_grid.walls
+        for index in room.wall_grid.walls_along(start, end):
+            entry = self.entry(walls[index], start, end)
+            if entry and (wall_hit is None or entry[0] < wall_hit[0]):
+                wall_hit = entry + (walls[index], "wall")
+        stop = wall_hit[1] if wall_hit else end
+
+        hits = []
+        seen = set()
+        for cell in grid_cells_along(start, stop, self.grid.cell_size):
+            self.cells_visited += 1
+            for layer in layers:
+                for target in self.grid.layers[layer].get(cell, ()):
+                    if id(target) in seen or target.health <= 0:
+                        continue
+                    seen.add(id(target))
+                    entry = self.entry(target.rect, start, stop)
+                    if entry:
+                        hits.append(entry + (target, layer))
+        hits.sort(key=lambda hit: hit[0])
+        if pierce is not None and 0 < pierce <= len(hits):
+            del hits[pierce:]
+            return hits, hits[-1][1]
+        if wall_hit:
+            hits.append(wall_hit)
+        return hits, stop
+
+    def cast_many(self, rays, room, pierce=None, layers=STOP_LAYERS):
+        self.refresh(room, layers)
+        return [self.cast(start, end, room, pierce, layers, refresh=False) for start, end in rays]
+
+
 class Game:
     def __init__(self):
         self.level = 1
@@ -723,38 +1838,153 @@ class Game:
         self.enemy_speed = 2
         self.enemy_health = 3
 
-def check_room_transition(player, room):
-    transition_dir = None
+def room_exit_direction(player):
     if player.rect.left > WIDTH:
-        transition_dir = 'RIGHT'
+        return 'RIGHT'
     elif player.rect.right < 0:
-        transition_dir = 'LEFT'
+        return 'LEFT'
     elif player.rect.top > HEIGHT:
-        transition_dir = 'DOWN'
+        return 'DOWN'
     elif player.rect.bottom < 0:
-        transition_dir = 'UP'
+        return 'UP'
+    return None
+
+
+def place_player_in_room(player, room, transition_dir):
+    player.rect.x += directions[transition_dir][0]
+    player.rect.y += directions[transition_dir][1]
+    player.rect = room.wall_grid.free_spot(player.rect)
 
+
+def check_room_transition(player, room):
+    transition_dir = room_exit_direction(player)
     if transition_dir:
-        transition()
+        events.emit("room_transition", transition_dir)
         new_room = Room()
-        player.rect.x += directions[transition_dir][0]
-        player.rect.y += directions[transition_dir][1]
-        while any(player.rect.colliderect(wall) for wall in new_room.walls):
-            player.rect.y -= 5
+        place_player_in_room(player, new_room, transition_dir)
         return new_room
     return room
 
 
+class RoomPrefetcher:
+    DIRECTIONS = ('UP', 'DOWN', 'LEFT', 'RIGHT')
+
+    def __init__(self, workers=1):
+        # workers=0 выключает предзагрузку: соседние комнаты строятся только при переходе
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="room-prefetch") if workers else None
+        self.base = None
+        self.number = None
+        self.candidates = {}
+        self.hits = 0
+        self.late = 0
+        self.misses = 0
+        self.discarded = 0
+        self.build_times = []
+
+    @staticmethod
+    def edge_distances(player):
+        return {
+            'UP': player.rect.bottom,
+            'DOWN': HEIGHT - player.rect.top,
+            'LEFT': player.rect.right,
+            'RIGHT': WIDTH - player.rect.left,
+        }
+
+    def build(self, number, coord):
+        start = time.perf_counter()
+        room = Room(number, streams.room(coord, number))
+        self.build_times.append((time.perf_counter() - start) * 1000)
+        return room
+
+    def discard(self):
+        for future in self.candidates.values():
+            if not future.cancel():
+                self.discarded += 1
+        self.candidates = {}
+
+    def close(self):
+        self.discard()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def update(self, room, player, graph):
+        if not self.workers:
+            return
+        if room is not self.base or self.number != Room.room_count + 1:
+            self.discard()
+            self.base = room
+            self.number = Room.room_count + 1
+
+        in_flight = sum(1 for future in self.candidates.values() if not future.done())
+        if in_flight >= self.workers:
+            return
+        # Сначала строим комнату за тем краем, к которому игрок ближе всего
+        distances = self.edge_distances(player)
+        for direction in sorted(graph.unexplored_directions(), key=distances.get):
+            if direction not in self.candidates:
+                self.candidates[direction] = self.executor.submit(self.build, self.number,
+                                                                  graph.neighbour(direction))
+                break
+
+    def take(self, direction):
+        future = self.candidates.pop(direction, None)
+        if future is None or self.number != Room.room_count + 1:
+            self.misses += 1
+            return None
+        if future.done():
+            self.hits += 1
+        else:
+            self.late += 1
+        self.discard()
+        self.base = None
+        return future
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "late": self.late,
+            "misses": self.misses,
+            "discarded": self.discarded,
+            "built": len(self.build_times),
+            "avg_build_ms": sum(self.build_times) / len(self.build_times) if self.build_times else 0.0,
+        }
+
+
+class RoomTransition:
+    FADE_TICKS = 15
+
+    def __init__(self, direction, future, coord=None, fresh=True):
+        self.direction = direction
+        self.future = future
+        self.coord = coord
+        self.fresh = fresh
+        self.phase = "out"
+        self.tick = 0
+        self.waited_ms = 0.0
+
+    def fading_out(self):
+        return self.phase == "out"
+
+    def phase_done(self):
+        return self.tick >= self.FADE_TICKS / STEP_SCALE
+
+    def alpha(self):
+        progress = min(1.0, self.tick * STEP_SCALE / self.FADE_TICKS)
+        if self.phase == "out":
+            return int(255 * progress)
+        return int(255 * (1 - progress))
+
+
 class Boss(pygame.sprite.Sprite):
     def __init__(self, x, y, level=1):
         super().__init__()
-        self.image = pygame.image.load("Boss.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (100, 100))
+        self.image = assets.image("Boss.png", (100, 100))
         self.rect = self.image.get_rect(center=(x, y))
         self.health = 20 + level + 5
         self.speed = 1.5 + level * 0.1
         self.shoot_delay = max(200, 500 - level * 30)
-        self.last_shot_time = pygame.time.get_ticks()
+        self.last_shot_time = now()
         self.phase = 1
         self.room = Room
         self.level = level
@@ -764,8 +1994,8 @@ class Boss(pygame.sprite.Sprite):
         direction = pygame.Vector2(player.rect.center) - pygame.Vector2(self.rect.center)
         if direction.length() > 0:
             direction = direction.normalize()
-            self.rect.x += direction.x * self.speed
-            self.rect.y += direction.y * self.speed
+            self.rect.x += direction.x * self.speed * STEP_SCALE
+            self.rect.y += direction.y * self.speed * STEP_SCALE
 
         if current_time - self.last_shot_time >= self.shoot_delay:
             if self.phase == 1:
@@ -775,22 +2005,20 @@ class Boss(pygame.sprite.Sprite):
                     angle = math.atan2(player.rect.centery - self.rect.centery, player.rect.centerx - self.rect.centerx) + offset
                     dx = math.cos(angle) * 10
                     dy = math.sin(angle) * 10
-                    bullet = Bullet(self.rect.centerx, self.rect.centery, (self.rect.centerx + dx, self.rect.centery + dy), "enemy")
-                    bullets.add(bullet)
+                    bullets.spawn(self.rect.centerx, self.rect.centery, (self.rect.centerx + dx, self.rect.centery + dy), "enemy")
             self.last_shot_time = current_time
 
         if self.health < (20 + self.level + 5) // 2:
             self.phase = 2
 
     def shoot(self, bullets, target_pos):
-        bullet = Bullet(self.rect.centerx, self.rect.centery, target_pos, "enemy")
-        bullets.add(bullet)
+        bullets.spawn(self.rect.centerx, self.rect.centery, target_pos, "enemy")
 
     def take_damage(self, player):
-        hit_sound.play()
+        play_sound("hit")
         self.health -= 1
         if self.health <= 0:
-            death_sound.play()
+            play_sound("death")
             self.kill()
             self.room.boss = None
             player.gain_xp(20)
@@ -800,15 +2028,25 @@ class Boss(pygame.sprite.Sprite):
 class Room:
     room_count = 0
     walls_count = 5
-
-    def __init__(self):
-        Room.room_count += 1
+    GRID_SIZE = 100
+    # Лёгкая дымка тумана лежит над стенами и ловушками, но под бочками и спрайтами
+    HAZE_COLOR = (100, 100, 100)
+    HAZE_ALPHA = 120
+    haze = None
+
+    def __init__(self, number=None, rng=None):
+        if number is None:
+            Room.room_count += 1
+            number = Room.room_count
+        self.number = number
+        self.rng = random if rng is None else rng
+        rng = self.rng
         self.enemies = pygame.sprite.Group()
         self.boss = None
         self.traps = pygame.sprite.Group()
         self.barrels = pygame.sprite.Group()
         self.ammo_bonus = 0
-        self.event = random.choice([None, "fog", "strong_enemies", "bullet_drift"])
+        self.event = rng.choice([None, "fog", "strong_enemies", "bullet_drift"])
         self.wind_direction = pygame.Vector2(0, 0)
         self.trader = None
         self.Trader = False
@@ -817,39 +2055,40 @@ class Room:
             self.walls = self.generate_walls()
         else:
             self.walls = []
+        self.wall_grid = WallGrid(self.walls, self.GRID_SIZE)
 
 
 
 
-        if Room.room_count % 10 == 0:
-            self.boss = Boss(WIDTH // 2, HEIGHT // 2, Room.room_count // 10)
-        elif random.randint(1, 8) == 1:
+        if number % 10 == 0:
+            self.boss = Boss(WIDTH // 2, HEIGHT // 2, number // 10)
+        elif rng.randint(1, 8) == 1:
             self.Trader = True
             self.trader = Trader(WIDTH // 2, HEIGHT // 2)
             self.enemies = pygame.sprite.Group()
             self.traps = pygame.sprite.Group()
             self.barrels = pygame.sprite.Group()
         else:
-            normal_count = min(3 + Room.room_count // 2, 10)
-            chasing_count = min(Room.room_count // 2, 10)
-            teleporting_count = min(Room.room_count // 4, 10)
+            normal_count = min(3 + number // 2, 10)
+            chasing_count = min(number // 2, 10)
+            teleporting_count = min(number // 4, 10)
             for _ in range(normal_count):
-                self.enemies.add(Enemy(random.randint(50, WIDTH - 50), random.randint(50, HEIGHT - 50)))
+                self.enemies.add(self.place(Enemy(rng.randint(50, WIDTH - 50), rng.randint(50, HEIGHT - 50))))
             for _ in range(chasing_count):
-                self.enemies.add(ChasingEnemy(random.randint(50, WIDTH - 50), random.randint(50, HEIGHT - 50)))
+                self.enemies.add(self.place(ChasingEnemy(rng.randint(50, WIDTH - 50), rng.randint(50, HEIGHT - 50))))
             for _ in range(teleporting_count):
-                self.enemies.add(TeleportBoss(random.randint(50, WIDTH - 50), random.randint(50, HEIGHT - 50)))
+                self.enemies.add(self.place(TeleportBoss(rng.randint(50, WIDTH - 50), rng.randint(50, HEIGHT - 50))))
         for _ in range(3):
             if not self.Trader:
-                trap_x = random.randint(100, WIDTH - 100)
-                trap_y = random.randint(100, HEIGHT - 100)
+                trap_x = rng.randint(100, WIDTH - 100)
+                trap_y = rng.randint(100, HEIGHT - 100)
                 self.traps.add(SpikeTrap(trap_x, trap_y))
 
-        for _ in range(random.randint(1, 2)):
+        for _ in range(rng.randint(1, 2)):
             if not self.Trader:
-                bx = random.randint(100, WIDTH - 100)
-                by = random.randint(100, HEIGHT - 100)
-                self.barrels.add(ExplosiveBarrel(bx, by))
+                bx = rng.randint(100, WIDTH - 100)
+                by = rng.randint(100, HEIGHT - 100)
+                self.barrels.add(self.place(ExplosiveBarrel(bx, by)))
 
 
 
@@ -859,27 +2098,155 @@ class Room:
                 enemy.health += 1
                 enemy.speed += 0.5
         if self.event == "bullet_drift":
-            angle = random.uniform(0, 2 * math.pi)
+            angle = rng.uniform(0, 2 * math.pi)
             self.wind_direction = pygame.Vector2(math.cos(angle), math.sin(angle)) * 0.3
 
+        self.prepare()
+
+    def wake(self):
+        # Таймеры выстрелов отсчитываем от входа в комнату, а не от момента фоновой постройки
+        current_time = now()
+        for enemy in self.enemies:
+            enemy.last_shot_time = current_time
+        if self.boss:
+            self.boss.last_shot_time = current_time
+
+    def place(self, sprite):
+        sprite.rect = self.wall_grid.free_spot(sprite.rect)
+        return sprite
+
+    def prepare(self):
+        self.flow_field = FlowField(self.walls)
+        # Слой строится лениво при первой отрисовке, то есть в главном потоке
+        # и только для текущей комнаты: заготовки и комнаты в графе его не держат
+        self.static_layer = None
+        self.static_version = 0
+        self.static_dirty = True
+
+    def kind(self):
+        if self.boss and self.boss.health > 0:
+            return "boss"
+        if self.Trader:
+            return "trader"
+        return "normal"
+
+    def cleared(self):
+        return not self.enemies and not (self.boss and self.boss.health > 0)
+
+    def snapshot(self):
+        # Только примитивы: состояние комнаты без поверхностей и спрайтов
+        boss = self.boss
+        return {
+            "number": self.number,
+            "event": self.event,
+            "wind": tuple(self.wind_direction),
+            "ammo_bonus": self.ammo_bonus,
+            "walls": [tuple(wall) for wall in self.walls],
+            "enemies": [(type(enemy).__name__, enemy.rect.centerx, enemy.rect.centery, enemy.health, enemy.speed)
+                        for enemy in self.enemies],
+            "boss": (boss.rect.centerx, boss.rect.centery, boss.level, boss.health, boss.phase)
+            if boss and boss.health > 0 else None,
+            "trader": (list(self.trader.weapon_options), list(self.trader.prices)) if self.trader else None,
+            "traps": [trap.rect.topleft for trap in self.traps],
+            "barrels": [(barrel.rect.centerx, barrel.rect.centery, barrel.health) for barrel in self.barrels],
+            "chips": [(type(chip).__name__, chip.rect.centerx, chip.rect.centery) for chip in self.chips],
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        room = cls.__new__(cls)
+        room.number = state["number"]
+        room.rng = random
+        room.event = state["event"]
+        room.wind_direction = pygame.Vector2(state["wind"])
+        room.ammo_bonus = state["ammo_bonus"]
+        room.walls = [pygame.Rect(wall) for wall in state["walls"]]
+        room.wall_grid = WallGrid(room.walls, cls.GRID_SIZE)
+        room.enemies = pygame.sprite.Group()
+        for kind, x, y, health, speed in state["enemies"]:
+            enemy = ENEMY_TYPES[kind](x, y)
+            enemy.health = health
+            enemy.speed = speed
+            room.enemies.add(enemy)
+        room.boss = None
+        if state["boss"]:
+            x, y, level, health, phase = state["boss"]
+            room.boss = Boss(x, y, level)
+            room.boss.health = health
+            room.boss.phase = phase
+        room.Trader = state["trader"] is not None
+        room.trader = None
+        if room.Trader:
+            room.trader = Trader(WIDTH // 2, HEIGHT // 2)
+            options, prices = state["trader"]
+            room.trader.weapon_options, room.trader.prices = list(options), list(prices)
+        room.traps = pygame.sprite.Group(SpikeTrap(x, y) for x, y in state["traps"])
+        room.barrels = pygame.sprite.Group()
+        for x, y, health in state["barrels"]:
+            barrel = ExplosiveBarrel(x, y)
+            barrel.health = health
+            room.barrels.add(barrel)
+        # Как и враги, подбираемые предметы восстанавливаются по имени класса и центру
+        room.chips = pygame.sprite.Group(globals()[kind](x, y) for kind, x, y in state["chips"])
+        room.prepare()
+        return room
+
+    def build_static_layer(self):
+        if self.static_layer is None or self.static_layer.get_size() != (WIDTH, HEIGHT):
+            self.static_layer = pygame.Surface((WIDTH, HEIGHT))
+            if pygame.display.get_surface() is not None:
+                self.static_layer = self.static_layer.convert()
+        layer = self.static_layer
+        layer.fill((30, 30, 30))
+        if self.trader:
+            self.draw_trader_decor(layer)
+            layer.blit(self.trader.image, self.trader.rect)
+        self.traps.draw(layer)
+        self.draw(layer)
+        if self.event == "fog":
+            layer.blit(self.haze_surface(), (0, 0))
+        self.barrels.draw(layer)
+        self.static_dirty = False
+        self.static_version += 1
+        return layer
+
+    @classmethod
+    def haze_surface(cls):
+        if cls.haze is None or cls.haze.get_size() != (WIDTH, HEIGHT):
+            cls.haze = pygame.Surface((WIDTH, HEIGHT))
+            if pygame.display.get_surface() is not None:
+                cls.haze = cls.haze.convert()
+            cls.haze.fill(cls.HAZE_COLOR)
+            cls.haze.set_alpha(cls.HAZE_ALPHA)
+        return cls.haze
+
+    def invalidate_static(self):
+        self.static_dirty = True
+
+    def release_static(self):
+        self.static_layer = None
+        self.static_dirty = True
+
+    def get_static_layer(self):
+        if self.static_dirty:
+            self.build_static_layer()
+        return self.static_layer
+
     def draw_trader_decor(self, surface):
-        self.image = pygame.image.load("rug.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (300, 250))
-        surface.blit(self.image, (self.trader.rect.centerx - 150, self.trader.rect.centery - 100))
+        rug = assets.image("rug.png", (300, 250))
+        surface.blit(rug, (self.trader.rect.centerx - 150, self.trader.rect.centery - 100))
 
-        self.image = pygame.image.load("torch.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (30, 80))
-        surface.blit(self.image, (self.trader.rect.left - 40, self.trader.rect.top))
-        surface.blit(self.image, (self.trader.rect.right + 15, self.trader.rect.top))
+        torch = assets.image("torch.png", (30, 80))
+        surface.blit(torch, (self.trader.rect.left - 40, self.trader.rect.top))
+        surface.blit(torch, (self.trader.rect.right + 15, self.trader.rect.top))
 
-        self.image = pygame.image.load("table.png").convert_alpha()
-        self.image = pygame.transform.scale(self.image, (120, 80))
-        surface.blit(self.image, (self.trader.rect.centerx - 55, self.trader.rect.bottom + 10))
+        table = assets.image("table.png", (120, 80))
+        surface.blit(table, (self.trader.rect.centerx - 55, self.trader.rect.bottom + 10))
 
     def generate_walls(self):
         walls = []
         max_tries = 100
-        grid_size = 100
+        grid_size = Room.GRID_SIZE
         grid_width = WIDTH // grid_size
         grid_height = HEIGHT // grid_size
         grid = [[False for _ in range(grid_width)] for _ in range(grid_height)]
@@ -888,12 +2255,14 @@ class Room:
         center_x, center_y = WIDTH // 2, HEIGHT // 2
 
         attempts = 0
-        while attempts < max_tries and len(walls) < Room.walls_count + Room.room_count:
-            width = random.randint(200, 400)
-            height = random.choice([20, random.randint(100, 300)])
+        number = getattr(self, "number", Room.room_count)
+        rng = getattr(self, "rng", random)
+        while attempts < max_tries and len(walls) < Room.walls_count + number:
+            width = rng.randint(200, 400)
+            height = rng.choice([20, rng.randint(100, 300)])
 
-            x_grid = random.randint(1, grid_width - 2)
-            y_grid = random.randint(1, grid_height - 2)
+            x_grid = rng.randint(1, grid_width - 2)
+            y_grid = rng.randint(1, grid_height - 2)
 
             x = x_grid * grid_size
             y = y_grid * grid_size
@@ -926,11 +2295,6 @@ class Room:
     def draw(self, surface):
         for wall in self.walls:
             pygame.draw.rect(surface, (127, 180, 240), wall)
-        if self.event == "fog":
-            fog = pygame.Surface((WIDTH, HEIGHT))
-            fog.set_alpha(120)
-            fog.fill((100, 100, 100))
-            surface.blit(fog, (0, 0))
 
     def check_room_transition(player, room):
         transition_dir = None
@@ -947,36 +2311,179 @@ class Room:
             if hasattr(room, 'boss') and room.boss and room.boss.alive():
                 return room
 
-            transition()
+            events.emit("room_transition", transition_dir)
             new_room = Room()
-            player.rect.x += directions[transition_dir][0]
-            player.rect.y += directions[transition_dir][1]
-            while any(player.rect.colliderect(wall) for wall in new_room.walls):
-                player.rect.y -= 5
+            place_player_in_room(player, new_room, transition_dir)
             return new_room
         return room
 
 
+ENEMY_TYPES = {cls.__name__: cls for cls in (Enemy, ChasingEnemy, TeleportBoss)}
+
+
+class RoomGraph:
+    OFFSETS = {'UP': (0, -1), 'DOWN': (0, 1), 'LEFT': (-1, 0), 'RIGHT': (1, 0)}
+    MINIMAP_RADIUS = 3
+    MINIMAP_CELL = 12
+    MINIMAP_COLORS = {"normal": (127, 180, 240), "trader": (255, 215, 0), "boss": (220, 40, 40)}
+    # Один временный каталог на процесс; у каждого графа свой префикс файлов
+    shared_dir = None
+    created = 0
+
+    def __init__(self, capacity=6, spill_dir=None):
+        RoomGraph.created += 1
+        self.prefix = RoomGraph.created
+        self.capacity = capacity
+        self.spill_dir = spill_dir or self.shared_spill_dir()
+        # Сжатие и запись идут в фоне; пока файл не записан, снимок берётся из памяти
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="room-spill")
+        self.writing = {}
+        self.hot = OrderedDict()
+        self.spilled = set()
+        self.info = {}
+        self.position = (0, 0)
+        self.version = 0
+        self.spills = 0
+        self.loads = 0
+        self.load_times = []
+
+    @classmethod
+    def shared_spill_dir(cls):
+        if cls.shared_dir is None:
+            cls.shared_dir = tempfile.mkdtemp(prefix="shooter-rooms-")
+            atexit.register(shutil.rmtree, cls.shared_dir, True)
+        return cls.shared_dir
+
+    def neighbour(self, direction, coord=None):
+        x, y = self.position if coord is None else coord
+        dx, dy = self.OFFSETS[direction]
+        return x + dx, y + dy
+
+    def unexplored_directions(self):
+        return tuple(direction for direction in self.OFFSETS if self.neighbour(direction) not in self.info)
+
+    def path(self, coord):
+        return os.path.join(self.spill_dir, "%d_%d_%d.room" % ((self.prefix,) + tuple(coord)))
+
+    def note(self, coord, room):
+        info = (room.number, room.kind(), room.cleared())
+        if self.info.get(coord) != info:
+            self.info[coord] = info
+            self.version += 1
+
+    def put(self, coord, room):
+        self.hot[coord] = room
+        self.hot.move_to_end(coord)
+        self.note(coord, room)
+        while len(self.hot) > self.capacity:
+            self.spill(*self.hot.popitem(last=False))
+
+    def enter(self, coord, room):
+        self.position = coord
+        self.put(coord, room)
+        self.version += 1
+
+    def spill(self, coord, room):
+        # Снимок из примитивов снимаем здесь, в игровом потоке; сжатие и диск уходят в фон
+        state = room.snapshot()
+        self.writing = {key: value for key, value in self.writing.items() if not value[1].done()}
+        self.writing[coord] = (state, self.writer.submit(self.write, self.path(coord), state))
+        self.spilled.add(coord)
+        self.spills += 1
+
+    @staticmethod
+    def write(path, state):
+        with open(path, "wb") as f:
+            f.write(zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL)))
+
+    def load(self, coord):
+        start = time.perf_counter()
+        pending = self.writing.get(coord)
+        if pending:
+            state = pending[0]
+        else:
+            with open(self.path(coord), "rb") as f:
+                state = pickle.loads(zlib.decompress(f.read()))
+        room = Room.from_state(state)
+        self.load_times.append((time.perf_counter() - start) * 1000)
+        self.loads += 1
+        return room
+
+    def fetch(self, coord, executor):
+        # Горячая комната отдаётся сразу, выгруженная читается с диска в фоне, неизвестная — None
+        if coord in self.hot:
+            future = Future()
+            future.set_result(self.hot[coord])
+            return future
+        if coord in self.spilled:
+            return executor.submit(self.load, coord)
+        return None
+
+    def flush(self):
+        for _, future in self.writing.values():
+            future.result()
+        self.writing = {}
+
+    def reset(self):
+        self.flush()
+        for coord in self.spilled:
+            try:
+                os.remove(self.path(coord))
+            except OSError:
+                pass
+        self.hot.clear()
+        self.spilled.clear()
+        self.info.clear()
+        self.position = (0, 0)
+        self.version += 1
+
+    def close(self):
+        self.reset()
+        self.writer.shutdown()
+
+    def disk_usage(self):
+        paths = (self.path(coord) for coord in self.spilled)
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    def stats(self):
+        return {
+            "visited": len(self.info),
+            "hot": len(self.hot),
+            "spilled": len(self.spilled),
+            "spills": self.spills,
+            "loads": self.loads,
+            "disk_bytes": self.disk_usage(),
+            "avg_load_ms": sum(self.load_times) / len(self.load_times) if self.load_times else 0.0,
+        }
+
+    def render_minimap(self):
+        radius = self.MINIMAP_RADIUS
+        cell = self.MINIMAP_CELL
+        size = (2 * radius + 1) * cell
+        surface = pygame.Surface((size, size), pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 120))
+        px, py = self.position
+        for (x, y), (number, kind, cleared) in self.info.items():
+            gx, gy = x - px + radius, y - py + radius
+            if not (0 <= gx <= 2 * radius and 0 <= gy <= 2 * radius):
+                continue
+            color = self.MINIMAP_COLORS[kind]
+            if cleared:
+                color = tuple(c // 2 for c in color)
+            pygame.draw.rect(surface, color, (gx * cell + 2, gy * cell + 2, cell - 4, cell - 4))
+        pygame.draw.rect(surface, (255, 255, 255), (radius * cell + 1, radius * cell + 1, cell - 2, cell - 2), 1)
+        return surface
+
+
 def draw_health_bar(surface, health, x, y):
     for i in range(health):
         pygame.draw.rect(surface, (255, 0, 0), (x + i * (HEART_SIZE + 5), y, HEART_SIZE, HEART_SIZE))
         pygame.draw.rect(surface, (255, 255, 255), (x + i * (HEART_SIZE + 5), y, HEART_SIZE, HEART_SIZE), 2)
 
 
-def transition():
-    for alpha in range(0, 255, 10):
-        fade = pygame.Surface((WIDTH, HEIGHT))
-        fade.fill((0, 0, 0))
-        fade.set_alpha(alpha)
-        screen.blit(fade, (0, 0))
-        pygame.display.update()
-        pygame.time.delay(20)
-
-
 def pause_game():
     paused = True
-    font = pygame.font.Font(None, 74)
-    pause_text = font.render("PAUSED", True, (255, 0, 0))
+    pause_text = text_cache.render("PAUSED", 74, (255, 0, 0))
     while paused:
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -1000,23 +2507,64 @@ def draw_ammo_bar(surface, ammo, reloading, x, y):
         pygame.draw.rect(surface, (255, 255, 255), (x + i * 20, y, 15, 30), 2)
 
     if reloading:
-        font = pygame.font.Font(None, 30)
-        reload_text = font.render("Reloading...", True, (255, 0, 0))
+        reload_text = text_cache.render("Reloading...", 30, (255, 0, 0))
         surface.blit(reload_text, (x, y + 30))
 
 
 
-def show_main_menu():
-    font = pygame.font.Font(None, 74)
-    start_text = font.render("Press Enter to Start", True, (255, 255, 255))
+# Всё, что нужно до первого кадра. Торговец, его декор и музыка сюда не входят:
+# они нужны редко и грузятся при первом обращении через assets.image
+STARTUP_IMAGES = (
+    ("background_menu.png", False), ("logo.png", True), ("Player.png", True),
+    ("pistol.png", True), ("shotgun.png", True), ("smg.png", True), ("laser.png", True), ("rocket.png", True),
+    *((f"assets/player/{state}_{i}.png", True) for state in ("idle", "run") for i in range(4)),
+    ("Enemy.png", True), ("ChacingEnemy.png", True), ("Boss.png", True), ("TeleportingBoss.png", True),
+    ("Bochka.png", True), ("Spike_Trap.png", True),
+)
+
+
+def draw_loading(done, total):
+    screen.fill((0, 0, 0))
+    text = text_cache.render(f"Loading... {done}/{total}", 40, (255, 255, 255))
+    screen.blit(text, (WIDTH // 2 - text.get_width() // 2, HEIGHT // 2 - 40))
+    bar = pygame.Rect(0, 0, WIDTH // 3, 16)
+    bar.center = (WIDTH // 2, HEIGHT // 2 + 10)
+    pygame.draw.rect(screen, (255, 255, 255), bar, 2)
+    pygame.draw.rect(screen, (255, 255, 255), (bar.x, bar.y, bar.width * done // max(total, 1), bar.height))
+    pygame.display.update()
+
+
+def load_startup_assets(executor):
+    # Файлы декодируются в пуле, а окно тем временем рисует прогресс и отвечает на события
+    jobs = {executor.submit(assets.decode, path): ("image", path, alpha) for path, alpha in STARTUP_IMAGES}
+    jobs.update({executor.submit(pygame.mixer.Sound, path): ("sound", path, None) for path in SoundPlayer.files()})
+    sounds = {}
+    pending = set(jobs)
+    draw_loading(0, len(jobs))
+    while pending:
+        finished, pending = wait(pending, timeout=1 / FPS, return_when=FIRST_COMPLETED)
+        for future in finished:
+            kind, path, alpha = jobs[future]
+            if kind == "image":
+                assets.adopt(path, future.result(), alpha)
+            else:
+                sounds[path] = future.result()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                sys.exit()
+        draw_loading(len(jobs) - len(pending), len(jobs))
+    return sounds
+
+
+def show_main_menu(music=None):
+    start_text = text_cache.render("Press Enter to Start", 74, (255, 255, 255))
 
 
-    background_image = pygame.image.load("background_menu.png")
-    background_image = pygame.transform.scale(background_image, (WIDTH, HEIGHT))
+    background_image = assets.image("background_menu.png", (WIDTH, HEIGHT), alpha=False)
 
 
-    logo_image = pygame.image.load("logo.png")
-    logo_image = pygame.transform.scale(logo_image, (550, 225))
+    logo_image = assets.image("logo.png", (550, 225))
 
     while True:
         screen.fill((0, 0, 0))
@@ -1027,6 +2575,8 @@ def show_main_menu():
         screen.blit(logo_image, (WIDTH // 2 - logo_image.get_width() // 2, HEIGHT // 6))
 
         pygame.display.update()
+        if music:
+            music.update()
 
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -1049,254 +2599,1016 @@ def show_main_menu():
             if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
                 return
 
-def main():
-    current_music_type = "normal"
-    trader_music = 'mystery_shop.wav'
-    pygame.mixer.music.load('Waveshaper - Client.mp3') #music
-    pygame.mixer.music.set_volume(0.1)
-    pygame.mixer.music.play(-1, 0.0)
-    show_main_menu()
-    running = True
-    player = Player(WIDTH // 2, HEIGHT // 2)
-    room = Room()
-    bullets = pygame.sprite.Group()
-    enemy_bullets = pygame.sprite.Group()
-    all_sprites = pygame.sprite.Group(player)
-    shake_duration = 300
-    shake_start_time = 0
-    wind_particles = pygame.sprite.Group()
-
-    while running:
-        screen.fill((30, 30, 30))
-        keys = pygame.key.get_pressed()
-        current_time = pygame.time.get_ticks()
-        if player.just_took_damage:
-            if pygame.time.get_ticks() - player.damage_effect_time < 150:
-                red_flash = pygame.Surface((WIDTH, HEIGHT))
-                red_flash.fill((255, 0, 0))
-                red_flash.set_alpha(90)
-                screen.blit(red_flash, (0, 0))
-            else:
-                player.just_took_damage = False
+class Simulation:
+    SNAP_DISTANCE = 120
+
+    def __init__(self, seed=None, prefetch=True):
+        sim_clock.reset()
+        streams.reseed(seed)
+        Room.room_count = 0
+        self.player = Player(WIDTH // 2, HEIGHT // 2)
+        self.projectiles = ProjectileStore()
+        self.all_sprites = pygame.sprite.Group(self.player)
+        self.wind_particles = ParticleSystem(capacity=512)
+        self.collision_grid = SpatialHash()
+        self.raycaster = Raycaster(self.collision_grid)
+        self.frame = 0
+        self.ticks = 0
+        self.recorder = None
+        self.prev_positions = {}
+        self.room_builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="room-builder")
+        self.prefetcher = RoomPrefetcher(workers=1 if prefetch else 0)
+        self.graph = RoomGraph()
+        self.transition = None
+        self.room = None
+        self.set_room(self.first_room())
+
+    @staticmethod
+    def first_room():
+        Room.room_count += 1
+        return Room(Room.room_count, streams.room((0, 0), Room.room_count))
+
+    def set_room(self, room, coord=(0, 0)):
+        if self.room is not None and self.room is not room:
+            self.room.release_static()
+        self.graph.enter(coord, room)
+        room.wake()
+        self.projectiles.set_room(room)
+        self.room = room
+        Room.current_room = room
+        with profiler.scope("room_change"):
+            events.emit("room_changed", room)
+
+    def close(self):
+        # Фоновые потоки и выгруженные на диск комнаты живут, пока их не закрыть
+        self.prefetcher.close()
+        self.room_builder.shutdown(wait=False, cancel_futures=True)
+        self.graph.close()
+
+    def restart(self):
+        player = self.player
+        player.reset(WIDTH // 2, HEIGHT // 2)
+        player.xp = 0
+        player.level = 1
+        player.xp_to_next = 10
+        player.perks = []
+        player.bullet_bounce = False
+        player.extra_projectiles = False
+        player.crit_chance = 0.0
+        player.DodgePlus = 0
+        player.reload_time = 0
+        player.chips = 100
+        self.transition = None
+        self.prefetcher.discard()
+        self.graph.reset()
+        streams.new_run()
+        self.set_room(self.first_room())
+
+    def start_transition(self, direction):
+        self.graph.note(self.graph.position, self.room)
+        coord = self.graph.neighbour(direction)
+        future = self.graph.fetch(coord, self.room_builder)
+        fresh = future is None
+        if fresh:
+            # Обычно соседняя комната уже построена префетчером; иначе строим её в фоне, пока экран затемняется
+            future = self.prefetcher.take(direction)
+        if future is None:
+            number = Room.room_count + 1
+            future = self.room_builder.submit(Room, number, streams.room(coord, number))
+        self.transition = RoomTransition(direction, future, coord, fresh)
+        events.emit("room_transition", direction)
+
+    def advance_transition(self):
+        transition = self.transition
+        transition.tick += 1
+        if not transition.phase_done():
+            return
+        if transition.phase == "out":
+            start = time.perf_counter()
+            new_room = transition.future.result()
+            transition.waited_ms = (time.perf_counter() - start) * 1000
+            place_player_in_room(self.player, new_room, transition.direction)
+            if transition.fresh:
+                Room.room_count = new_room.number
+            self.set_room(new_room, transition.coord)
+            self.prev_positions = {}
+            transition.phase = "in"
+            transition.tick = 0
+        else:
+            self.transition = None
+
+    def entity_counts(self):
+        projectiles = self.projectiles
+        alive = projectiles.alive
+        return {
+            "bullets": int(np.count_nonzero(alive & (projectiles.owner == ProjectileStore.PLAYER))),
+            "enemy_bullets": int(np.count_nonzero(alive & (projectiles.owner == ProjectileStore.ENEMY))),
+            "blood": len(blood_particles),
+            "wind": len(self.wind_particles),
+            "enemies": len(self.room.enemies) + (1 if self.room.boss and self.room.boss.health > 0 else 0),
+        }
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                player.shoot(bullets, pygame.mouse.get_pos())
-            if event.type == pygame.KEYDOWN and event.key == pygame.K_r:
-                if not player.alive:
-                    player.reset(WIDTH // 2, HEIGHT // 2)
-                    player.xp = 0
-                    player.level = 1
-                    player.xp_to_next = 10
-                    player.perks = []
-                    player.bullet_bounce = False
-                    player.extra_projectiles = False
-                    player.crit_chance = 0.0
-                    player.DodgePlus = 0
-                    player.reload_time = 0
-                    player.chips = 100
-                    room = Room()
-            if event.type == pygame.KEYDOWN and event.key == pygame.K_p:
-                pause_game()
-            if event.type == pygame.MOUSEWHEEL:
-                player.switch_weapon(event.y)
-            if event.type == pygame.KEYDOWN and event.key == pygame.K_m:
-                show_main_menu()
+    def pick_perk(self, index):
+        if self.recorder:
+            self.recorder.record(self.ticks, ["p", index])
+        self.player.apply_perk(self.player.perk_options[index])
+
+    def digest(self):
+        # Отпечаток состояния симуляции для сверки записи и повтора
+        player = self.player
+        room = self.room
+        state = (
+            self.ticks, Room.room_count, room.number, self.graph.position,
+            tuple(player.rect), player.health, player.ammo, player.xp, player.level, player.chips,
+            tuple((type(enemy).__name__, tuple(enemy.rect), enemy.health) for enemy in room.enemies),
+            (tuple(room.boss.rect), room.boss.health) if room.boss else None,
+            tuple(tuple(barrel.rect) for barrel in room.barrels),
+            self.projectiles.pos[self.projectiles.alive].tobytes(),
+        )
+        return "%08x" % zlib.crc32(repr(state).encode())
+
+    def handle_event(self, event, mouse_pos):
+        player = self.player
+        room = self.room
+        if self.recorder:
+            self.recorder.record_event(self.ticks, event, mouse_pos)
+        if self.transition and self.transition.fading_out():
+            return
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            player.shoot(self.projectiles, mouse_pos, self.raycaster)
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_r:
+            if not player.alive:
+                self.restart()
+        if event.type == pygame.MOUSEWHEEL:
+            player.switch_weapon(event.y)
+
+        if event.type == pygame.KEYDOWN:
+            if room.trader and player.rect.colliderect(room.trader.rect):
+                if event.key == pygame.K_1:
+                    room.trader.interact(player, 0)
+                elif event.key == pygame.K_2:
+                    room.trader.interact(player, 1)
+                elif event.key == pygame.K_3:
+                    room.trader.interact(player, 2)
+
+    def moving_sprites(self):
+        yield self.player
+        yield from self.room.enemies
+        if self.room.boss:
+            yield self.room.boss
+
+    def snapshot_positions(self):
+        self.prev_positions = {sprite: sprite.rect.topleft for sprite in self.moving_sprites()}
+        self.projectiles.snapshot()
+
+    def lerp_position(self, sprite, alpha):
+        x, y = sprite.rect.topleft
+        prev = self.prev_positions.get(sprite)
+        if prev is None:
+            return x, y
+        px, py = prev
+        # Телепорты и переходы между комнатами не размазываем
+        if abs(x - px) + abs(y - py) > self.SNAP_DISTANCE:
+            return x, y
+        return px + (x - px) * alpha, py + (y - py) * alpha
+
+    def step(self, keys):
+        if self.recorder:
+            self.recorder.record_keys(self.ticks, keys)
+        self.ticks += 1
+        if self.transition:
+            fading_out = self.transition.fading_out()
+            with profiler.scope("transition"):
+                self.advance_transition()
+            if fading_out:
+                return
 
-            if event.type == pygame.KEYDOWN:
-                if room.trader and player.rect.colliderect(room.trader.rect):
-                    if event.key == pygame.K_1:
-                        room.trader.interact(player, 0)
-                    elif event.key == pygame.K_2:
-                        room.trader.interact(player, 1)
-                    elif event.key == pygame.K_3:
-                        room.trader.interact(player, 2)
+        player = self.player
+        direction = room_exit_direction(player)
+        if direction and not self.transition:
+            self.start_transition(direction)
+            return
 
-        room = check_room_transition(player, room)
+        self.snapshot_positions()
+        sim_clock.advance()
+        current_time = now()
+        room = self.room
+        if not self.transition:
+            with profiler.scope("transition"):
+                self.prefetcher.update(room, player, self.graph)
 
-        Room.current_room = room
+        with profiler.scope("flow_field"):
+            room.wall_grid.begin_frame()
+            room.flow_field.update(player.rect.center)
 
-        if room.trader and current_music_type != "trader":
-            pygame.mixer.music.load(trader_music)
-            pygame.mixer.music.play(-1)
-            current_music_type = "trader"
-        elif not room.trader and current_music_type != "normal":
-            pygame.mixer.music.load('Waveshaper - Client.mp3')
-            pygame.mixer.music.play(-1)
-            current_music_type = "normal"
+        with profiler.scope("movement"):
+            self.all_sprites.update(keys, room.wall_grid, current_time)
 
-        all_sprites.update(keys, room.walls, current_time)
+            for enemy in room.enemies:
+                if isinstance(enemy, ChasingEnemy):
+                    enemy.update(player, self.projectiles, current_time, room.wall_grid, room.flow_field)
+                else:
+                    enemy.update(player, self.projectiles, current_time)
 
-        for enemy in room.enemies:
-            if isinstance(enemy, ChasingEnemy):
-                enemy.update(player, enemy_bullets, current_time, room.walls)
-            else:
-                enemy.update(player, enemy_bullets, current_time)
+            if room.boss and room.boss.health >= 0:
+                room.boss.update(player, self.projectiles, current_time)
 
-        bullets.update()
-        enemy_bullets.update()
+        with profiler.scope("bullets"):
+            self.projectiles.update()
+        with profiler.scope("collisions"):
+            self.resolve_collisions()
 
-        for bullet in bullets:
-            for barrel in list(room.barrels):
-                if bullet.rect.colliderect(barrel.rect):
-                    barrel.take_damage(player, room)
-                    bullet.kill()
+        with profiler.scope("particles"):
+            blood_particles.update()
 
+        if player.health <= 0:
             for enemy in room.enemies:
+                enemy.shoot_delay = float('inf')
+
+        with profiler.scope("traps"):
+            room.traps.update(player, current_time)
+
+            room.chips.update()
+            for chip in room.chips:
+                if player.rect.colliderect(chip.rect):
+                    chip.collect(player)
+
+        if room.event == "bullet_drift":
+            with profiler.scope("particles"):
+                cosmetic = streams.particles
+                if cosmetic.random() < 0.4 * STEP_SCALE:
+                    spawn_x = cosmetic.integers(0, WIDTH + 1)
+                    spawn_y = cosmetic.integers(0, HEIGHT + 1)
+                    velocity = room.wind_direction * cosmetic.uniform(1.0, 2.5)
+                    self.wind_particles.emit(spawn_x, spawn_y, velocity.x, velocity.y, (200, 200, 255), size=4,
+                                             gravity=0, fade=0, shape=ParticleSystem.SQUARE)
+                self.wind_particles.update()
+
+        self.frame += 1
+
+    def resolve_collisions(self):
+        player = self.player
+        room = self.room
+        grid = self.collision_grid
+        grid.clear()
+        grid.insert_all("player_bullets", self.projectiles.handles(ProjectileStore.PLAYER))
+        grid.insert_all("enemy_bullets", self.projectiles.handles(ProjectileStore.ENEMY))
+        grid.insert_all("enemies", room.enemies)
+        if room.boss and room.boss.health >= 0:
+            grid.insert("enemies", room.boss)
+        grid.insert_all("barrels", room.barrels)
+        grid.insert("player", player)
+
+        for bullet, barrel in grid.pairs("player_bullets", "barrels"):
+            if barrel.health > 0 and bullet.alive() and bullet.rect.colliderect(barrel.rect):
+                barrel.take_damage(player, room)
+                bullet.kill()
+
+        for bullet, enemy in grid.pairs("player_bullets", "enemies"):
+            if bullet.alive() and enemy.health > 0:
                 bullet.check_collision(enemy, player)
-        for bullet in enemy_bullets:
-            if bullet.shooter == "enemy" and bullet.rect.colliderect(player.rect):
+
+        for bullet, _ in grid.pairs("enemy_bullets", "player"):
+            if bullet.alive() and bullet.shooter == "enemy" and bullet.rect.colliderect(player.rect):
                 player.take_damage()
                 bullet.kill()
 
-        blood_particles.update()
-        blood_particles.draw(screen)
 
-        if player.health <= 0:
-            for enemy in room.enemies:
-                enemy.shoot_delay = float('inf')
-            font = pygame.font.Font(None, 74)
-            restart_text = font.render("You Lost! Press R to Restart", True, (255, 255, 255))
-            screen.blit(restart_text, (WIDTH // 2 - restart_text.get_width() // 2, HEIGHT // 2))
+def render_text_lines(lines, size, spacing):
+    rendered = [text_cache.render(text, size, color) for text, color in lines]
+    width = max(text.get_width() for text in rendered)
+    surface = pygame.Surface((width, spacing * (len(rendered) - 1) + rendered[-1].get_height()), pygame.SRCALPHA)
+    for i, text in enumerate(rendered):
+        surface.blit(text, (0, i * spacing))
+    return surface
+
+
+def render_health_widget(health):
+    if health <= 0:
+        return None
+    surface = pygame.Surface((health * (HEART_SIZE + 5), HEART_SIZE), pygame.SRCALPHA)
+    draw_health_bar(surface, health, 0, 0)
+    return surface
+
+
+def render_ammo_widget(value):
+    ammo, reloading = value
+    surface = pygame.Surface((120, 60), pygame.SRCALPHA)
+    draw_ammo_bar(surface, ammo, reloading, 0, 0)
+    return surface
+
+
+def render_wind_widget(wind):
+    if wind is None:
+        return None
+    surface = pygame.Surface((100, 100), pygame.SRCALPHA)
+    wind_angle = math.atan2(wind[1], wind[0])
+    end_x = 50 + math.cos(wind_angle) * 40
+    end_y = 50 + math.sin(wind_angle) * 40
+    pygame.draw.line(surface, (180, 180, 255), (50, 50), (end_x, end_y), 4)
+    pygame.draw.circle(surface, (200, 200, 255), (50, 50), 8)
+    return surface
+
+
+def render_trader_widget(value):
+    if value is None:
+        return None
+    options, prices = value[:2]
+    lines = []
+    for i, option in enumerate(options):
+        if option == "SOLD":
+            lines.append((f"{i + 1}. SOLD", (255, 0, 0)))
+        else:
+            lines.append((f"{i + 1}. {option} - {prices[i]} chips", (255, 255, 255)))
+    return render_text_lines(lines, 24, 25)
+
+
+class HudWidget:
+    def __init__(self, name, bind, render, position):
+        self.name = name
+        self.bind = bind
+        self.render = render
+        self.position = position
+        self.value = object()
+        self.image = None
+        self.rect = None
+        self.renders = 0
+
+    def refresh(self, value):
+        self.value = value
+        self.image = self.render(value)
+        self.renders += 1
+        if self.image is None:
+            self.rect = None
+        else:
+            position = self.position(value, self.image) if callable(self.position) else self.position
+            self.rect = self.image.get_rect(topleft=position)
 
-        draw_health_bar(screen, player.health, 10, 10)
-        draw_ammo_bar(screen, player.ammo, player.reloading, 10, HEIGHT - 50)
 
-        font = pygame.font.Font(None, 30)
-        level_text = font.render(f"Level: {player.level}", True, (255, 255, 255))
-        xp_text = font.render(f"XP: {player.xp}/{player.xp_to_next}", True, (100, 255, 100))
+class Hud:
+    def __init__(self):
+        self.surface = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
+        self.widgets = []
+        self.rects = []
+        self.redraws = 0
+
+        def text_widget(size, color, fmt):
+            return lambda value: None if value is None else text_cache.render(fmt(value), size, color)
+
+        def player_value(attr):
+            return lambda sim: getattr(sim.player, attr)
+
+        self.add("health", player_value("health"), render_health_widget, (10, 10))
+        self.add("ammo", lambda sim: (sim.player.ammo, sim.player.reloading), render_ammo_widget, (10, HEIGHT - 50))
+        self.add("level", player_value("level"), text_widget(30, (255, 255, 255), "Level: {}".format), (10, 50))
+        self.add("xp", lambda sim: (sim.player.xp, sim.player.xp_to_next),
+                 text_widget(30, (100, 255, 100), lambda v: f"XP: {v[0]}/{v[1]}"), (10, 80))
+        self.add("chips", player_value("chips"), text_widget(30, (0, 255, 255), "Chips: {}".format), (10, 110))
+        self.add("weapon", lambda sim: sim.player.unlocked_weapons[sim.player.current_weapon],
+                 text_widget(30, (255, 255, 255), "Weapon: {}".format), (10, 140))
+        self.add("event", lambda sim: sim.room.event,
+                 text_widget(30, (255, 255, 0), "Room Event: {}".format), (WIDTH - 250, 10))
+        self.add("wind", lambda sim: tuple(sim.room.wind_direction) if sim.room.event == "bullet_drift" else None,
+                 render_wind_widget, (WIDTH - 150, HEIGHT - 150))
+        self.add("trader", self.trader_value, render_trader_widget, lambda value, image: value[2:])
+        self.add("minimap", lambda sim: (sim.graph.version, sim.graph), lambda value: value[1].render_minimap(),
+                 (WIDTH - 94, 50))
+        self.add("death", lambda sim: sim.player.health <= 0, self.render_death,
+                 lambda value, image: (WIDTH // 2 - image.get_width() // 2, HEIGHT // 2))
+
+    def add(self, name, bind, render, position):
+        widget = HudWidget(name, bind, render, position)
+        self.widgets.append(widget)
+        return widget
+
+    @staticmethod
+    def trader_value(sim):
+        trader = sim.room.trader
+        if trader is None or not sim.player.rect.colliderect(trader.rect):
+            return None
+        return tuple(trader.weapon_options), tuple(trader.prices), trader.rect.x, trader.rect.bottom
+
+    @staticmethod
+    def render_death(dead):
+        if not dead:
+            return None
+        return text_cache.render("You Lost! Press R to Restart", 74, (255, 255, 255))
+
+    def update(self, sim):
+        damaged = []
+        for widget in self.widgets:
+            value = widget.bind(sim)
+            if value == widget.value:
+                continue
+            if widget.rect:
+                damaged.append(widget.rect)
+            widget.refresh(value)
+            if widget.rect:
+                damaged.append(widget.rect)
+        if not damaged:
+            return
 
-        screen.blit(level_text, (10, 50))
-        screen.blit(xp_text, (10, 80))
+        # Перекрывающиеся виджеты дорисовываем из их кэшированных картинок
+        for rect in damaged:
+            self.surface.fill((0, 0, 0, 0), rect)
+            self.surface.set_clip(rect)
+            for widget in self.widgets:
+                if widget.rect and widget.rect.colliderect(rect):
+                    self.surface.blit(widget.image, widget.rect)
+        self.surface.set_clip(None)
+        self.rects = [widget.rect for widget in self.widgets if widget.rect]
+        self.redraws += 1
 
-        if room.event:
-            font = pygame.font.Font(None, 30)
-            text = font.render(f"Room Event: {room.event}", True, (255, 255, 0))
-            screen.blit(text, (WIDTH - 250, 10))
+    def draw(self, surface):
+        surface.blits([(self.surface, rect, rect) for rect in self.rects], doreturn=False)
+        return self.rects
+
+
+class OverlayCompositor:
+    EFFECTS = {
+        "fog": (50, 50, 50),
+        "flash": (255, 200, 100),
+        "damage": (255, 0, 0),
+        "fade": (0, 0, 0),
+    }
+    # Туман лежит между спрайтами и боевым слоем (вражеские пули, оружие, босс),
+    # остальные эффекты накрывают весь кадр. Сливаются только слои одной группы.
+    FOG = ("fog",)
+    SCREEN = ("flash", "damage", "fade")
+
+    def __init__(self, size):
+        self.size = size
+        self.surfaces = {}
+        self.active = {}
+        self.colors = dict(self.EFFECTS)
+        self.merged = {}
+        self.blits = 0
+
+    def _new_surface(self, color):
+        surface = pygame.Surface(self.size)
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert()
+        surface.fill(color)
+        return surface
+
+    def effect_surface(self, name):
+        surface = self.surfaces.get(name)
+        if surface is None:
+            surface = self._new_surface(self.colors[name])
+            self.surfaces[name] = surface
+        return surface
+
+    def set(self, name, alpha, color=None):
+        if color is not None and tuple(color) != self.colors[name]:
+            self.colors[name] = tuple(color)
+            if name in self.surfaces:
+                self.surfaces[name].fill(color)
+        if alpha <= 0:
+            self.active.pop(name, None)
+        else:
+            self.active[name] = min(255, int(alpha))
 
-        if room.event == "bullet_drift":
-            wind = room.wind_direction
-            wind_angle = math.atan2(wind.y, wind.x)
-            x = WIDTH - 100
-            y = HEIGHT - 100
-            length = 40
-            end_x = x + math.cos(wind_angle) * length
-            end_y = y + math.sin(wind_angle) * length
-            pygame.draw.line(screen, (180, 180, 255), (x, y), (end_x, end_y), 4)
-            pygame.draw.circle(screen, (200, 200, 255), (x, y), 8)
-
-        if player.choosing_perk:
-            font = pygame.font.Font(None, 36)
-            choice_text = font.render("Choose a perk:", True, (255, 255, 255))
-            screen.blit(choice_text, (WIDTH // 2 - 100, HEIGHT // 3 - 40))
-
-            for i, perk in enumerate(player.perk_options):
-                perk_text = font.render(f"{i + 1}. {perk}", True, (200, 200, 50))
-                screen.blit(perk_text, (WIDTH // 2 - 100, HEIGHT // 3 + i * 40))
-
-
-
-            pygame.display.flip()
-
-            waiting = True
-            while waiting:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        pygame.quit()
-                        sys.exit()
-                    if event.type == pygame.KEYDOWN:
-                        if event.key in [pygame.K_1, pygame.K_KP1]:
-                            player.apply_perk(player.perk_options[0])
-                            waiting = False
-                        elif event.key in [pygame.K_2, pygame.K_KP2]:
-                            player.apply_perk(player.perk_options[1])
-                            waiting = False
-                        elif event.key in [pygame.K_3, pygame.K_KP3]:
-                            player.apply_perk(player.perk_options[2])
-                            waiting = False
-                    if event.type == pygame.KEYDOWN:
-                        if room.trader and player.rect.colliderect(room.trader.rect):
-                            if event.key == pygame.K_1:
-                                room.trader.interact(player, 0)
-                            elif event.key == pygame.K_2:
-                                room.trader.interact(player, 1)
-                            elif event.key == pygame.K_3:
-                                room.trader.interact(player, 2)
-                    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:  # ПКМ
-                        current_time = pygame.time.get_ticks()
-                        if player.relic and current_time - player.last_relic_use > player.relic_cooldown:
-                            player.use_relic()
-                            player.last_relic_use = current_time
-
-        if pygame.time.get_ticks() - shake_start_time < shake_duration:
-            shake_offset = [random.randint(-5, 5), random.randint(-5, 5)]
-            screen.blit(screen.copy(), shake_offset)
-
-        if room.trader:
-            room.draw_trader_decor(screen)
-            screen.blit(room.trader.image, room.trader.rect)
-            font = pygame.font.Font(None, 24)
-            if player.rect.colliderect(room.trader.rect):
-                for i, option in enumerate(room.trader.weapon_options):
-                    display_text = f"{i + 1}. {option} - {room.trader.prices[i]} chips"
-                    if option == "SOLD":
-                        text_color = (255, 0, 0)
-                        display_text = f"{i + 1}. SOLD"
-                    else:
-                        text_color = (255, 255, 255)
-                    text = font.render(display_text, True, text_color)
-                    screen.blit(text, (room.trader.rect.x, room.trader.rect.bottom + i * 25))
-
-        room.traps.update(player, current_time)
-        room.traps.draw(screen)
-        room.draw(screen)
-        room.enemies.draw(screen)
-        all_sprites.draw(screen)
-        bullets.draw(screen)
-        room.barrels.draw(screen)
-        chip_text = font.render(f"Chips: {player.chips}", True, (0, 255, 255))
-        screen.blit(chip_text, (10, 110))
-
-        room.chips.update()
-        room.chips.draw(screen)
-
-        for chip in room.chips:
-            if player.rect.colliderect(chip.rect):
-                chip.collect(player)
-
-
-
-        if room.event == "fog":
-            fog_surface = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
-            fog_surface.fill((50, 50, 50, 220))
-            screen.blit(fog_surface, (0, 0))
-
-        enemy_bullets.draw(screen)
-        room = check_room_transition(player, room)
-        if room.event == "bullet_drift":
-            if random.random() < 0.4:
-                spawn_x = random.randint(0, WIDTH)
-                spawn_y = random.randint(0, HEIGHT)
-                wind_particles.add(WindParticle(spawn_x, spawn_y, room.wind_direction))
+    def clear(self, name=None):
+        if name is None:
+            self.active.clear()
+        else:
+            self.active.pop(name, None)
+
+    def composite(self, names=None):
+        # Несколько однотонных слоёв подряд = один однотонный слой
+        keep = 1.0
+        color = [0.0, 0.0, 0.0]
+        for name in names or self.EFFECTS:
+            alpha = self.active.get(name)
+            if not alpha:
+                continue
+            a = alpha / 255
+            r, g, b = self.colors[name]
+            color = [color[0] * (1 - a) + r * a, color[1] * (1 - a) + g * a, color[2] * (1 - a) + b * a]
+            keep *= 1 - a
+        total = 1 - keep
+        if total <= 0:
+            return None, 0
+        return tuple(min(255, round(c / total)) for c in color), round(total * 255)
+
+    def draw(self, surface, names=None):
+        names = names or tuple(self.EFFECTS)
+        active = [name for name in names if name in self.active]
+        if not active:
+            return
+        if len(active) == 1:
+            name = active[0]
+            overlay = self.effect_surface(name)
+            overlay.set_alpha(self.active[name])
+        else:
+            color, alpha = self.composite(names)
+            overlay, key = self.merged.get(names, (None, None))
+            if overlay is None:
+                overlay = self._new_surface(color)
+            elif color != key:
+                overlay.fill(color)
+            self.merged[names] = overlay, color
+            overlay.set_alpha(alpha)
+        surface.blit(overlay, (0, 0))
+        self.blits += 1
 
-            wind_particles.update()
-            wind_particles.draw(screen)
 
-        player.draw_weapon(screen, pygame.mouse.get_pos())
+class Camera:
+    KICK_HALF_LIFE = 40
 
-        if room.boss and room.boss.health >= 0:
-            screen.blit(room.boss.image, room.boss.rect)
-            room.boss.update(player, enemy_bullets, current_time)
-            for bullet in bullets:
-                bullet.check_collision(room.boss, player)
+    def __init__(self):
+        self.position = pygame.Vector2(0, 0)
+        self.kick = pygame.Vector2(0, 0)
+        self.shake_until = 0
+        self.shake_magnitude = 0
+        self.offset = (0, 0)
+        self.last_time = None
+        # Свой генератор, чтобы тряска не влияла на случайность симуляции
+        self.rng = random.Random()
+
+    def shake(self, duration, magnitude):
+        self.shake_until = max(self.shake_until, now() + duration)
+        self.shake_magnitude = max(magnitude, self.shake_magnitude if self.shaking() else 0)
+
+    def add_kick(self, dx, dy):
+        self.kick += (dx, dy)
+
+    def shaking(self):
+        return now() < self.shake_until
+
+    def update(self):
+        current = now()
+        if self.last_time is not None and current > self.last_time:
+            self.kick *= 0.5 ** ((current - self.last_time) / self.KICK_HALF_LIFE)
+        self.last_time = current
+        if self.kick.length_squared() < 0.25:
+            self.kick.update(0, 0)
+
+        x = -self.position.x + self.kick.x
+        y = -self.position.y + self.kick.y
+        if self.shaking():
+            m = self.shake_magnitude
+            x += self.rng.randint(-m, m)
+            y += self.rng.randint(-m, m)
+        self.offset = (int(x), int(y))
+        return self.offset
+
+    def moving(self):
+        return self.offset != (0, 0)
+
+    def apply(self, pos):
+        return pos[0] + self.offset[0], pos[1] + self.offset[1]
+
+
+class Renderer:
+    def __init__(self, bus):
+        self.effects = []
+        self.show_collision_debug = False
+        self.camera = Camera()
+        self.hud = Hud()
+        self.overlays = OverlayCompositor((WIDTH, HEIGHT))
+        self.flash = None
+        self.pixels_pushed = 0
+        self.show_profiler = False
+        self.profiler_image = None
+        self.bus = bus
+        self.subscriptions = (("laser", self.on_laser), ("flash", self.on_flash),
+                              ("shake", self.camera.shake), ("recoil", self.camera.add_kick))
+        for kind, callback in self.subscriptions:
+            bus.subscribe(kind, callback)
+
+    def close(self):
+        for kind, callback in self.subscriptions:
+            self.bus.unsubscribe(kind, callback)
+
+    def on_laser(self, start, end, duration=LASER_MS):
+        self.effects.append(("line", (0, 255, 255), start, end, now(), duration))
+
+    def on_flash(self, color, alpha):
+        self.flash = (color, alpha)
+
+    def draw_effects(self, surface):
+        rects = []
+        current_time = now()
+        # Эффекты живут по времени симуляции: луч гаснет за duration мс, сужаясь
+        self.effects = [effect for effect in self.effects if current_time - effect[4] <= effect[5]]
+        for kind, color, start, end, born, duration in self.effects:
+            if kind == "line":
+                width = 1 + round(3 * (1 - (current_time - born) / duration)) if duration else 4
+                rects.append(pygame.draw.line(surface, color, self.camera.apply(start), self.camera.apply(end), width))
+        return rects
+
+    def update_overlays(self, sim):
+        overlays = self.overlays
+        overlays.set("fog", 220 if sim.room.event == "fog" else 0)
+
+        player = sim.player
+        if player.just_took_damage:
+            if now() - player.damage_effect_time < 150:
+                overlays.set("damage", 90)
+            else:
+                player.just_took_damage = False
+                overlays.set("damage", 0)
+        else:
+            overlays.set("damage", 0)
 
+        if self.flash:
+            overlays.set("flash", self.flash[1], self.flash[0])
+            self.flash = None
+        else:
+            overlays.set("flash", 0)
+
+        overlays.set("fade", sim.transition.alpha() if sim.transition else 0)
+
+    def draw_group(self, surface, sim, sprites, alpha):
+        ox, oy = self.camera.offset
+        blits = []
+        for sprite in sprites:
+            x, y = sim.lerp_position(sprite, alpha)
+            blits.append((sprite.image, (x + ox, y + oy)))
+        return surface.blits(blits)
+
+    def draw_static(self, room, surface):
+        if self.camera.moving():
+            # Открывшиеся края экрана закрашиваем цветом пола
+            surface.fill((30, 30, 30))
+        surface.blit(room.get_static_layer(), self.camera.offset)
+
+    def draw_dynamic(self, sim, surface, alpha):
+        room = sim.room
+        offset = self.camera.offset
+        rects = blood_particles.draw(surface, return_rects=True, offset=offset)
+        rects += self.draw_group(surface, sim, room.enemies, alpha)
+        rects += self.draw_group(surface, sim, sim.all_sprites, alpha)
+        rects += self.draw_group(surface, sim, room.chips, alpha)
+        rects += sim.projectiles.draw(surface, alpha, offset, ProjectileStore.PLAYER)
+        return rects
+
+    def draw_combat(self, sim, surface, mouse_pos, alpha):
+        # Всё, что рисуется поверх тумана и должно оставаться видимым
+        room = sim.room
+        offset = self.camera.offset
+        rects = sim.projectiles.draw(surface, alpha, offset, ProjectileStore.ENEMY)
+        if room.event == "bullet_drift":
+            rects += sim.wind_particles.draw(surface, return_rects=True, offset=offset)
+        player = sim.player
+        x, y = sim.lerp_position(player, alpha)
+        center = (x + player.rect.width / 2, y + player.rect.height / 2)
+        rects.append(player.draw_weapon(surface, mouse_pos, offset, center))
+        if room.boss and room.boss.health >= 0:
+            x, y = sim.lerp_position(room.boss, alpha)
+            rects.append(surface.blit(room.boss.image, (x + offset[0], y + offset[1])))
+        rects += self.draw_effects(surface)
+        return rects
+
+    def draw_profiler(self, surface):
+        if not self.show_profiler:
+            return []
+        # Текст оверлея пересобираем раз в 15 кадров, чтобы не засорять кэш текста
+        if self.profiler_image is None or profiler.frames % 15 == 0:
+            self.profiler_image = profiler.render()
+        return [surface.blit(self.profiler_image, (10, 180))]
+
+    def draw(self, sim, surface, mouse_pos, alpha=1.0):
+        self.camera.update()
+        with profiler.scope("static"):
+            self.draw_static(sim.room, surface)
+        self.update_overlays(sim)
+        with profiler.scope("dynamic"):
+            self.draw_dynamic(sim, surface, alpha)
+        with profiler.scope("overlays"):
+            self.overlays.draw(surface, OverlayCompositor.FOG)
+        with profiler.scope("dynamic"):
+            self.draw_combat(sim, surface, mouse_pos, alpha)
+        with profiler.scope("overlays"):
+            self.overlays.draw(surface, OverlayCompositor.SCREEN)
+
+        with profiler.scope("hud"):
+            self.hud.update(sim)
+            self.hud.draw(surface)
+
+        if self.show_collision_debug:
+            sim.collision_grid.draw_debug(surface)
+        self.draw_profiler(surface)
+
+    def present(self):
         pygame.display.flip()
-        clock.tick(FPS)
+        self.pixels_pushed = WIDTH * HEIGHT
+
+    def invalidate(self):
+        # Кадр и так перерисовывается целиком
+        pass
+
+
+class DirtyRenderer(Renderer):
+    # pygame.sprite.LayeredDirty здесь не подходит: снаряды и частицы живут в массивах NumPy,
+    # а не в спрайтах, и все позиции интерполируются между тиками. Пришлось бы каждый кадр
+    # заворачивать всё в DirtySprite, лишь чтобы группа сама стёрла прошлые места по фону.
+    # Поэтому делаем то же вручную: стираем прошлые прямоугольники запечённым слоем комнаты
+    # и выводим на экран только их и то, что нарисовано в этом кадре
+    def __init__(self, bus):
+        super().__init__(bus)
+        self.background = None
+        self.background_key = None
+        self.previous_rects = []
+        self.update_rects = None
+        self.screen_effects = False
+
+    def refresh_background(self, room):
+        self.background = room.get_static_layer()
+        key = (id(room), room.static_version)
+        if key == self.background_key:
+            return False
+        self.background_key = key
+        return True
+
+    def draw(self, sim, surface, mouse_pos, alpha=1.0):
+        self.camera.update()
+        self.update_overlays(sim)
+        changed = self.refresh_background(sim.room)
+        # Полноэкранные эффекты меняют каждый пиксель: тогда проще обновить весь экран,
+        # и ещё один кадр после них, чтобы стереть их следы
+        screen_effects = bool(self.overlays.active) or self.camera.moving() or self.show_collision_debug
+        full = changed or screen_effects or self.screen_effects
+        self.screen_effects = screen_effects
+
+        with profiler.scope("static"):
+            if full:
+                self.draw_static(sim.room, surface)
+            else:
+                surface.blits([(self.background, rect, rect) for rect in self.previous_rects], doreturn=False)
+
+        with profiler.scope("dynamic"):
+            rects = self.draw_dynamic(sim, surface, alpha)
+        with profiler.scope("overlays"):
+            self.overlays.draw(surface, OverlayCompositor.FOG)
+        with profiler.scope("dynamic"):
+            rects += self.draw_combat(sim, surface, mouse_pos, alpha)
+        with profiler.scope("overlays"):
+            self.overlays.draw(surface, OverlayCompositor.SCREEN)
+
+        with profiler.scope("hud"):
+            self.hud.update(sim)
+            rects += self.hud.draw(surface)
+
+        if self.show_collision_debug:
+            sim.collision_grid.draw_debug(surface)
+        rects += self.draw_profiler(surface)
+
+        screen_rect = surface.get_rect()
+        rects = [rect.clip(screen_rect) for rect in rects]
+        self.update_rects = None if full else self.previous_rects + rects
+        self.previous_rects = [rect for rect in rects if rect.width and rect.height]
+
+    def present(self):
+        if self.update_rects is None:
+            super().present()
+            return
+        pygame.display.update(self.update_rects)
+        self.pixels_pushed = sum(rect.width * rect.height for rect in self.update_rects)
+
+    def invalidate(self):
+        # Пауза, меню и выбор перка рисуют поверх всего экрана: следующий кадр
+        # перерисовываем и выводим целиком, иначе их пиксели останутся на экране
+        self.background_key = None
+        self.previous_rects = []
+        self.update_rects = None
+
+
+def choose_perk(sim, surface):
+    player = sim.player
+    room = sim.room
+    choice_text = text_cache.render("Choose a perk:", 36, (255, 255, 255))
+    surface.blit(choice_text, (WIDTH // 2 - 100, HEIGHT // 3 - 40))
+
+    for i, perk in enumerate(player.perk_options):
+        perk_text = text_cache.render(f"{i + 1}. {perk}", 36, (200, 200, 50))
+        surface.blit(perk_text, (WIDTH // 2 - 100, HEIGHT // 3 + i * 40))
+
+    pygame.display.flip()
+
+    waiting = True
+    while waiting:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                sys.exit()
+            if event.type == pygame.KEYDOWN:
+                if event.key in [pygame.K_1, pygame.K_KP1]:
+                    sim.pick_perk(0)
+                    waiting = False
+                elif event.key in [pygame.K_2, pygame.K_KP2]:
+                    sim.pick_perk(1)
+                    waiting = False
+                elif event.key in [pygame.K_3, pygame.K_KP3]:
+                    sim.pick_perk(2)
+                    waiting = False
+            if event.type == pygame.KEYDOWN:
+                if room.trader and player.rect.colliderect(room.trader.rect):
+                    sim.handle_event(event, pygame.mouse.get_pos())
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:  # ПКМ
+                current_time = now()
+                if player.relic and current_time - player.last_relic_use > player.relic_cooldown:
+                    player.use_relic()
+                    player.last_relic_use = current_time
+
+
+class HeadlessKeys:
+    def __init__(self, pressed=()):
+        self.pressed = set(pressed)
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+
+def run_headless(frames=5000, size=(1920, 1080)):
+    init_game(headless=True, size=size)
+    sim = Simulation()
+    keys = HeadlessKeys()
+    start = time.perf_counter()
+    for frame in range(frames):
+        profiler.begin_frame()
+        with profiler.scope("simulation"):
+            sim.step(keys)
+        if sim.player.choosing_perk:
+            sim.pick_perk(0)
+        profiler.end_frame(sim.entity_counts())
+    elapsed = time.perf_counter() - start
+    sim.close()
+    return {"frames": frames, "seconds": elapsed, "fps": frames / elapsed, "profile": profiler.stats()}
+
+
+class InputRecorder:
+    KEYS = (pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d, pygame.K_SPACE)
+
+    def __init__(self, path, seed, size):
+        self.file = open(path, "w")
+        self.keymask = None
+        self.entries = 0
+        self.write({"seed": seed, "tick_rate": TICK_RATE, "size": list(size)})
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.entries += 1
+
+    def record(self, tick, entry):
+        self.write([tick] + entry)
+
+    def record_keys(self, tick, keys):
+        # Состояние клавиш пишем только при изменении
+        mask = sum(1 << i for i, key in enumerate(self.KEYS) if keys[key])
+        if mask != self.keymask:
+            self.keymask = mask
+            self.record(tick, ["k", mask])
+
+    def record_event(self, tick, event, mouse_pos):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            self.record(tick, ["m", event.button, mouse_pos[0], mouse_pos[1]])
+        elif event.type == pygame.KEYDOWN:
+            self.record(tick, ["d", event.key])
+        elif event.type == pygame.MOUSEWHEEL:
+            self.record(tick, ["w", event.y])
+
+    def close(self, tick, digest):
+        self.record(tick, ["end", digest])
+        self.file.close()
+
+
+def replay(path):
+    with open(path) as f:
+        header = json.loads(f.readline())
+        entries = [json.loads(line) for line in f]
+    init_game(headless=True, size=header["size"])
+    set_tick_rate(header["tick_rate"])
+    sim = Simulation(seed=header["seed"])
+    keys = HeadlessKeys()
+    end_tick, recorded = entries[-1][0], entries[-1][2]
+    index = 0
+    start = time.perf_counter()
+    for tick in range(end_tick + 1):
+        while index < len(entries) and entries[index][0] == tick:
+            kind, *args = entries[index][1:]
+            if kind == "k":
+                keys = HeadlessKeys(key for i, key in enumerate(InputRecorder.KEYS) if args[0] >> i & 1)
+            elif kind == "m":
+                sim.handle_event(pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=args[0]), args[1:])
+            elif kind == "d":
+                sim.handle_event(pygame.event.Event(pygame.KEYDOWN, key=args[0]), (0, 0))
+            elif kind == "w":
+                sim.handle_event(pygame.event.Event(pygame.MOUSEWHEEL, y=args[0]), (0, 0))
+            elif kind == "p":
+                sim.pick_perk(args[0])
+            index += 1
+        if tick < end_tick:
+            sim.step(keys)
+    elapsed = time.perf_counter() - start
+    digest = sim.digest()
+    sim.close()
+    return {"ticks": sim.ticks, "seconds": elapsed, "digest": digest, "recorded": recorded,
+            "match": digest == recorded}
 
+
+def main():
+    init_game()
+    loader = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="asset-loader")
+    # Музыку ставим в очередь первой: mp3 декодируется дольше всего и доиграет уже в меню
+    music = MusicPlayer(events, loader)
+    sound = SoundPlayer(events, load_startup_assets(loader))
+    if "--dirty-rects" in sys.argv:
+        renderer = DirtyRenderer(events)
+    else:
+        renderer = Renderer(events)
+    print(f"startup: menu after {(time.perf_counter() - STARTED_AT) * 1000:.0f} ms", file=sys.stderr)
+    show_main_menu(music)
+    game_started = time.perf_counter()
+    first_frame = True
+    running = True
+    seed = int(sys.argv[sys.argv.index("--seed") + 1]) if "--seed" in sys.argv else None
+    max_fps = int(sys.argv[sys.argv.index("--max-fps") + 1]) if "--max-fps" in sys.argv else RENDER_FPS
+    sim = Simulation(seed)
+    if "--record" in sys.argv:
+        sim.recorder = InputRecorder(sys.argv[sys.argv.index("--record") + 1], streams.seed, (WIDTH, HEIGHT))
+    if "--profile-csv" in sys.argv:
+        profiler.open_csv(sys.argv[sys.argv.index("--profile-csv") + 1])
+
+    accumulator = 0.0
+    previous = time.perf_counter()
+
+    while running:
+        profiler.begin_frame()
+        current = time.perf_counter()
+        accumulator += (current - previous) * 1000
+        previous = current
+        keys = pygame.key.get_pressed()
+        mouse_pos = pygame.mouse.get_pos()
+
+        with profiler.scope("input"):
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_p:
+                    pause_game()
+                    renderer.invalidate()
+                    music.resume()
+                    profiler.discard_frame()
+                    previous = time.perf_counter()
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_m:
+                    show_main_menu(music)
+                    renderer.invalidate()
+                    music.resume()
+                    profiler.discard_frame()
+                    previous = time.perf_counter()
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    renderer.show_collision_debug = not renderer.show_collision_debug
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                    renderer.show_profiler = not renderer.show_profiler
+                sim.handle_event(event, mouse_pos)
+
+        with profiler.scope("simulation"):
+            ticks = 0
+            while accumulator >= TICK_MS and ticks < MAX_TICKS_PER_FRAME:
+                sim.step(keys)
+                accumulator -= TICK_MS
+                ticks += 1
+            if ticks == MAX_TICKS_PER_FRAME:
+                # Не пытаемся догнать всё отставание после долгого кадра
+                accumulator = min(accumulator, TICK_MS)
+
+        with profiler.scope("audio"):
+            sound.flush()
+            music.update()
+
+        with profiler.scope("draw"):
+            renderer.draw(sim, screen, mouse_pos, accumulator / TICK_MS)
+
+        if sim.player.choosing_perk:
+            choose_perk(sim, screen)
+            renderer.invalidate()
+            music.resume()
+            profiler.discard_frame()
+            previous = time.perf_counter()
+
+        with profiler.scope("present"):
+            renderer.present()
+        if first_frame:
+            first_frame = False
+            print(f"startup: first frame {(time.perf_counter() - game_started) * 1000:.0f} ms after the menu",
+                  file=sys.stderr)
+        # Время ожидания в clock.tick в кадр не входит: считаем только работу
+        profiler.end_frame(dict(sim.entity_counts(), pixels_pushed=renderer.pixels_pushed))
+        clock.tick(max_fps)
+
+    if sim.recorder:
+        sim.recorder.close(sim.ticks, sim.digest())
+    sim.close()
+    profiler.close()
     pygame.quit()
 
 
 if __name__ == "__main__":
-    main()
+    if "--replay" in sys.argv:
+        print(replay(sys.argv[sys.argv.index("--replay") + 1]))
+    elif "--headless" in sys.argv:
+        print(run_headless())
+    else:
+        main()
@@ -0,0 +1,399 @@
+# Сценарные бенчмарки горячих путей игры: без окна, под SDL_VIDEODRIVER=dummy
+#
+#   python benchmarks.py --output bench.json
+#   python benchmarks.py --baseline bench.json --output new.json
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+# Иначе приветствие pygame попадает в stdout перед JSON
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GAME_PATH = os.path.join(HERE, "Shooter 1+2 (1).py")
+
+
+def load_game():
+    # Имя файла с пробелами и скобками не импортируется обычным import
+    spec = importlib.util.spec_from_file_location("shooter", GAME_PATH)
+    game = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(game)
+    return game
+
+
+class FunctionTimer:
+    # (имя в отчёте, класс или None для функции модуля, атрибут)
+    TARGETS = (
+        ("has_line_of_sight", None, "has_line_of_sight"),
+        ("Room.generate_walls", "Room", "generate_walls"),
+        ("Bullet.check_collision", "Bullet", "check_collision"),
+        # Бывший BloodParticle.update: теперь одна векторная функция на все частицы
+        ("ParticleSystem.update", "ParticleSystem", "update"),
+    )
+
+    def __init__(self, game):
+        self.game = game
+        self.originals = []
+        self.calls = {}
+        self.totals = {}
+
+    def wrap(self, label, original):
+        calls = self.calls
+        totals = self.totals
+        perf_counter = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                totals[label] += perf_counter() - start
+                calls[label] += 1
+        return timed
+
+    def __enter__(self):
+        for label, owner_name, attr in self.TARGETS:
+            owner = self.game if owner_name is None else getattr(self.game, owner_name)
+            original = owner.__dict__[attr]
+            self.originals.append((owner, attr, original))
+            self.calls[label] = 0
+            self.totals[label] = 0.0
+            setattr(owner, attr, self.wrap(label, original))
+        return self
+
+    def __exit__(self, *exc):
+        for owner, attr, original in reversed(self.originals):
+            setattr(owner, attr, original)
+        self.originals = []
+
+    def report(self):
+        return {
+            label: {
+                "calls": self.calls[label],
+                "total_ms": self.totals[label] * 1000,
+                "mean_us": self.totals[label] * 1e6 / self.calls[label] if self.calls[label] else 0.0,
+            }
+            for label in self.calls
+        }
+
+
+def generated_walls(game, streams, number):
+    # Только стены, без врагов и слоёв: как Room.from_state, собираем комнату без __init__
+    room = game.Room.__new__(game.Room)
+    room.number = number
+    room.rng = streams.room((number, 0), number)
+    return room.generate_walls()
+
+
+def line_of_sight_sampled(game, start_pos, end_pos, walls):
+    # Исходная проверка видимости: эталон для WallGrid.line_of_sight
+    steps = int(game.pygame.Vector2(end_pos).distance_to(start_pos) // 5)
+    for i in range(steps):
+        x = start_pos[0] + (end_pos[0] - start_pos[0]) * i / steps
+        y = start_pos[1] + (end_pos[1] - start_pos[1]) * i / steps
+        point = game.pygame.Rect(x, y, 2, 2)
+        if any(point.colliderect(wall) for wall in walls):
+            return False
+    return True
+
+
+def check_line_of_sight_compat(game, rooms=50, samples=200, seed=0):
+    streams = game.RandomStreams(seed)
+    rng = streams.combat
+    mismatches = 0
+    for number in range(1, rooms + 1):
+        walls = generated_walls(game, streams, number)
+        grid = game.WallGrid(walls)
+        for _ in range(samples):
+            start = (rng.randint(0, game.WIDTH), rng.randint(0, game.HEIGHT))
+            end = (rng.randint(0, game.WIDTH), rng.randint(0, game.HEIGHT))
+            if grid.line_of_sight(start, end) != line_of_sight_sampled(game, start, end, walls):
+                mismatches += 1
+    return {"mismatches": mismatches, "samples": rooms * samples}
+
+
+def benchmark_flow_field(game, counts=(10, 100, 1000), frames=120, seed=0):
+    streams = game.RandomStreams(seed)
+    rng = streams.combat
+    results = {}
+    for count in counts:
+        # Одна и та же раскладка стен для всех размеров: меняется только число преследователей
+        walls = generated_walls(game, streams, 1)
+        wall_grid = game.WallGrid(walls)
+        flow_field = game.FlowField(walls)
+        player = game.pygame.sprite.Sprite()
+        player.rect = game.pygame.Rect(0, 0, 50, 50)
+        chasers = [game.ChasingEnemy(rng.randint(50, game.WIDTH - 50), rng.randint(50, game.HEIGHT - 50))
+                   for _ in range(count)]
+        bullets = game.ProjectileStore()
+        start = time.perf_counter()
+        for frame in range(frames):
+            player.rect.center = (game.WIDTH * frame // frames, game.HEIGHT // 2)
+            wall_grid.begin_frame()
+            flow_field.update(player.rect.center)
+            for chaser in chasers:
+                chaser.update(player, bullets, 0, wall_grid, flow_field)
+        elapsed = time.perf_counter() - start
+        results[count] = {
+            "ms_per_frame": elapsed * 1000 / frames,
+            "field_rebuilds": flow_field.rebuilds,
+        }
+    return results
+
+
+def check_laser_hits_boss(game):
+    # Босс не входит в room.enemies: луч должен находить его и без тика resolve_collisions
+    sim = game.Simulation(seed=4, prefetch=False)
+    room = empty_room(game, sim)
+    room.walls = []
+    room.wall_grid = game.WallGrid(room.walls, room.GRID_SIZE)
+    boss = game.Boss(game.WIDTH // 2, 150)
+    room.boss = boss
+    player = sim.player
+    player.rect.center = (game.WIDTH // 2, game.HEIGHT - 100)
+    player.unlocked_weapons = ["laser"]
+    player.current_weapon = 0
+    before = boss.health
+    player.shoot(sim.projectiles, boss.rect.center, sim.raycaster)
+    after = boss.health
+    sim.close()
+    return {"health_before": before, "health_after": after, "ok": after < before}
+
+
+def empty_room(game, sim):
+    room = sim.room
+    room.enemies.empty()
+    room.barrels.empty()
+    room.boss = None
+    room.event = None
+    room.invalidate_static()
+    sim.projectiles.set_room(room)
+    return room
+
+
+def run_frames(game, sim, frames, before_step=None):
+    # Сетка столкновений обнуляет счётчик каждый тик: суммируем его за весь прогон
+    renderer = getattr(game, RENDERER)(game.events)
+    keys = game.HeadlessKeys()
+    pair_tests = 0
+    pixels = 0
+    start = time.perf_counter()
+    for frame in range(frames):
+        if before_step:
+            before_step(frame)
+        sim.step(keys)
+        pair_tests += sim.collision_grid.pair_tests
+        sim.player.health = 3
+        renderer.draw(sim, game.screen, (0, 0))
+        renderer.present()
+        pixels += renderer.pixels_pushed
+    elapsed = time.perf_counter() - start
+    renderer.close()
+    sim.close()
+    return elapsed, {"pair_tests": pair_tests, "pixels_per_frame": pixels // frames}
+
+
+def scenario_shotgun_room(game, frames):
+    sim = game.Simulation(seed=1, prefetch=False)
+    room = empty_room(game, sim)
+    player = sim.player
+    player.unlocked_weapons = ["shotgun"]
+    player.current_weapon = 0
+    rng = random.Random(1)
+    spawned = [0]
+
+    def before_step(frame):
+        while len(room.enemies) < 30:
+            spawned[0] += 1
+            room.enemies.add(room.place(game.Enemy(rng.randint(50, game.WIDTH - 50), rng.randint(50, game.HEIGHT - 50))))
+        if frame % 10 == 0:
+            player.ammo = 99
+            player.reloading = False
+            target = min(room.enemies, key=lambda enemy: abs(enemy.rect.centerx - player.rect.centerx)
+                         + abs(enemy.rect.centery - player.rect.centery))
+            player.shoot(sim.projectiles, target.rect.center, sim.raycaster)
+
+    elapsed, stats = run_frames(game, sim, frames, before_step)
+    return elapsed, {"kills": spawned[0] - len(room.enemies), **stats}
+
+
+def scenario_gore_burst(game, frames):
+    particles = game.ParticleSystem(capacity=8192)
+    saved = game.blood_particles
+    game.blood_particles = particles
+    try:
+        gore = [game.Enemy(game.WIDTH // 2, game.HEIGHT // 2) for _ in range(100)]
+        for enemy in gore:
+            enemy.explode_gore()
+        peak = len(particles)
+        start = time.perf_counter()
+        for _ in range(frames):
+            particles.update()
+            game.screen.fill((30, 30, 30))
+            particles.draw(game.screen)
+            game.pygame.display.flip()
+        elapsed = time.perf_counter() - start
+    finally:
+        game.blood_particles = saved
+    return elapsed, {"peak_particles": peak, "evicted": particles.evicted}
+
+
+def scenario_boss_volley(game, frames):
+    sim = game.Simulation(seed=2, prefetch=False)
+    room = empty_room(game, sim)
+    boss = game.Boss(game.WIDTH // 2, 150, level=3)
+    boss.phase = 2
+    boss.health = (20 + boss.level + 5) // 2 - 1
+    room.boss = boss
+    sim.player.rect.center = (game.WIDTH // 2, game.HEIGHT - 100)
+    peak = [0]
+
+    def before_step(frame):
+        # Босс не должен дойти до игрока: держим дистанцию, чтобы залпы шли весь прогон
+        boss.rect.centery = 150
+        peak[0] = max(peak[0], sim.entity_counts()["enemy_bullets"])
+
+    elapsed, stats = run_frames(game, sim, frames, before_step)
+    return elapsed, {"peak_enemy_bullets": peak[0], **stats}
+
+
+def scenario_chasers(game, frames):
+    sim = game.Simulation(seed=3, prefetch=False)
+    room = empty_room(game, sim)
+    rng = random.Random(3)
+    for _ in range(100):
+        room.enemies.add(room.place(game.ChasingEnemy(rng.randint(50, game.WIDTH - 50),
+                                                      rng.randint(50, game.HEIGHT - 50))))
+    elapsed, stats = run_frames(game, sim, frames)
+    grid = room.wall_grid
+    return elapsed, {
+        **stats,
+        "sight_queries": grid.sight_queries,
+        "sight_cache_hits": grid.sight_hits,
+        "field_rebuilds": room.flow_field.rebuilds,
+    }
+
+
+def scenario_room_generation(game, frames):
+    # Те же номера, что дали бы подряд вызовы Room(), но каждая комната из своего сида
+    streams = game.RandomStreams(5)
+    start = time.perf_counter()
+    for number in range(1, frames + 1):
+        game.Room(number, streams.room((number, 0), number))
+    elapsed = time.perf_counter() - start
+    return elapsed, {"ms_per_room": elapsed * 1000 / frames}
+
+
+# Рендерер сценариев с Simulation; --dirty-rects меряет DirtyRenderer
+RENDERER = "Renderer"
+
+# (имя, функция, кадров или построек; в --quick делим на 10)
+SCENARIOS = (
+    ("shotgun_room_30", scenario_shotgun_room, 600),
+    ("gore_burst_5000", scenario_gore_burst, 300),
+    ("boss_phase2_volley", scenario_boss_volley, 600),
+    ("chasers_100_los", scenario_chasers, 300),
+    ("room_generation_1000", scenario_room_generation, 1000),
+)
+
+
+def run(names=None, quick=False, size=(1280, 720), dirty_rects=False):
+    global RENDERER
+    RENDERER = "DirtyRenderer" if dirty_rects else "Renderer"
+    os.chdir(HERE)
+    game = load_game()
+    game.init_game(size=size)
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "pygame": game.pygame.version.ver,
+            "numpy": game.np.__version__,
+            "size": list(size),
+            "quick": quick,
+            "renderer": RENDERER,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "scenarios": {},
+    }
+    for name, scenario, frames in SCENARIOS:
+        if names and name not in names:
+            continue
+        frames = max(1, frames // 10) if quick else frames
+        game.blood_particles.clear()
+        with FunctionTimer(game) as timer:
+            elapsed, extra = scenario(game, frames)
+        results["scenarios"][name] = {
+            "frames": frames,
+            "seconds": elapsed,
+            "fps": frames / elapsed,
+            "functions": timer.report(),
+            **extra,
+        }
+        print(f"{name:<22} {frames / elapsed:10.1f} fps", file=sys.stderr)
+
+    results["checks"] = {
+        "line_of_sight_compat": check_line_of_sight_compat(game, rooms=5 if quick else 50),
+        "flow_field": benchmark_flow_field(game, frames=12 if quick else 120),
+        "laser_hits_boss": check_laser_hits_boss(game),
+    }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Сравниваем fps по общим сценариям; падение больше tolerance считается регрессией
+    regressions = []
+    if results["meta"]["quick"] != baseline.get("meta", {}).get("quick"):
+        print("warning: comparing a --quick run with a full one, fps are not comparable", file=sys.stderr)
+    if results["meta"]["renderer"] != baseline.get("meta", {}).get("renderer", "Renderer"):
+        print("warning: the runs used different renderers, fps are not comparable", file=sys.stderr)
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        change = current["fps"] / previous["fps"] - 1
+        current["baseline_fps"] = previous["fps"]
+        current["change"] = change
+        flag = "REGRESSION" if change < -tolerance else ""
+        print(f"{name:<22} {previous['fps']:10.1f} -> {current['fps']:10.1f} fps  {change:+7.1%} {flag}",
+              file=sys.stderr)
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless scenario benchmarks")
+    parser.add_argument("--output", help="write results as JSON to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed fps drop before failing")
+    parser.add_argument("--scenario", action="append", help="run only this scenario (repeatable)")
+    parser.add_argument("--quick", action="store_true", help="one tenth of the frames, for smoke runs")
+    parser.add_argument("--dirty-rects", action="store_true", help="measure the dirty-rectangle renderer")
+    args = parser.parse_args()
+
+    results = run(args.scenario, args.quick, dirty_rects=args.dirty_rects)
+    regressions = [name for name, check in results["checks"].items() if check.get("ok") is False]
+    for name in regressions:
+        print(f"check failed: {name}", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions += compare(results, json.load(f), args.tolerance)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())